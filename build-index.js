@@ -1,28 +0,0 @@
-// from https://lunrjs.com/guides/index_prebuilding.html
-var lunr = require('lunr'),
-    stdin = process.stdin,
-    stdout = process.stdout,
-    buffer = []
-
-stdin.resume()
-stdin.setEncoding('utf8')
-
-stdin.on('data', function (data) {
-  buffer.push(data)
-})
-
-stdin.on('end', function () {
-  var documents = JSON.parse(buffer.join(''))
-
-  var idx = lunr(function () {
-    this.ref('link')
-    this.field('title')
-    this.field('body')
-
-    documents.forEach(function (doc) {
-      this.add(doc)
-    }, this)
-  })
-
-  stdout.write(JSON.stringify(idx))
-})
\ No newline at end of file
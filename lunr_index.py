@@ -0,0 +1,300 @@
+"""
+Lunr search index builder for Massive Wiki Builder.
+
+Builds the same serialized index as lunr.js 2.3.9 (`lunr(function () { this.ref('link'); this.field('title');
+this.field('body'); ... })`), so it can be loaded in the browser with `lunr.Index.load`. Documents are
+added one at a time, and only their term frequencies are kept.
+"""
+from array import array
+import json
+import math
+import re
+import tempfile
+
+__all__ = ['LunrIndexBuilder', 'tokenize', 'stem', 'shard_key']
+
+LUNR_VERSION = '2.3.9'
+
+# lunr.tokenizer.separator - JavaScript's \s, plus hyphen
+SEPARATOR = re.compile(r'[\t\n\v\f\r \u00a0\u1680\u2000-\u200a\u2028\u2029\u202f\u205f\u3000\ufeff-]+')
+
+# lunr.trimmer - JavaScript's \W is ASCII-only
+TRIM_START = re.compile(r'^[^A-Za-z0-9_]+')
+TRIM_END = re.compile(r'[^A-Za-z0-9_]+$')
+
+# lunr.stopWordFilter
+STOP_WORDS = frozenset('''
+a able about across after all almost also am among an and any are as at be because been but by can
+cannot could dear did do does either else ever every for from get got had has have he her hers him his
+how however i if in into is it its just least let like likely may me might most must my neither no nor
+not of off often on only or other our own rather said say says she should since so some than that the
+their them then there these they this tis to too twas us wants was we were what when where which while
+who whom why will with would yet you your
+'''.split())
+
+# lunr.stemmer - a port of lunr's Porter stemmer, regular expression for regular expression
+STEP2 = {
+    'ational': 'ate', 'tional': 'tion', 'enci': 'ence', 'anci': 'ance', 'izer': 'ize', 'bli': 'ble',
+    'alli': 'al', 'entli': 'ent', 'eli': 'e', 'ousli': 'ous', 'ization': 'ize', 'ation': 'ate',
+    'ator': 'ate', 'alism': 'al', 'iveness': 'ive', 'fulness': 'ful', 'ousness': 'ous', 'aliti': 'al',
+    'iviti': 'ive', 'biliti': 'ble', 'logi': 'log',
+}
+STEP3 = {'icate': 'ic', 'ative': '', 'alize': 'al', 'iciti': 'ic', 'ical': 'ic', 'ful': '', 'ness': ''}
+
+_c = '[^aeiou]'          # consonant
+_v = '[aeiouy]'          # vowel
+_C = _c + '[^aeiouy]*'   # consonant sequence
+_V = _v + '[aeiou]*'     # vowel sequence
+
+RE_MGR0 = re.compile('^(' + _C + ')?' + _V + _C)                      # [C]VC... is m>0
+RE_MEQ1 = re.compile('^(' + _C + ')?' + _V + _C + '(' + _V + ')?$')   # [C]VC[V] is m=1
+RE_MGR1 = re.compile('^(' + _C + ')?' + _V + _C + _V + _C)            # [C]VCVC... is m>1
+RE_S_V = re.compile('^(' + _C + ')?' + _v)                            # vowel in stem
+
+RE_1A = re.compile(r'^(.+?)(ss|i)es$')
+RE2_1A = re.compile(r'^(.+?)([^s])s$')
+RE_1B = re.compile(r'^(.+?)eed$')
+RE2_1B = re.compile(r'^(.+?)(ed|ing)$')
+RE2_1B_2 = re.compile(r'(at|bl|iz)$')
+RE3_1B_2 = re.compile(r'([^aeiouylsz])\1$')
+RE4_1B_2 = re.compile('^' + _C + _v + '[^aeiouwxy]$')
+RE_1C = re.compile(r'^(.+?[^aeiou])y$')
+RE_2 = re.compile(r'^(.+?)(ational|tional|enci|anci|izer|bli|alli|entli|eli|ousli|ization|ation|ator|alism|iveness|fulness|ousness|aliti|iviti|biliti|logi)$')
+RE_3 = re.compile(r'^(.+?)(icate|ative|alize|iciti|ical|ful|ness)$')
+RE_4 = re.compile(r'^(.+?)(al|ance|ence|er|ic|able|ible|ant|ement|ment|ent|ou|ism|ate|iti|ous|ive|ize)$')
+RE2_4 = re.compile(r'^(.+?)(s|t)(ion)$')
+RE_5 = re.compile(r'^(.+?)e$')
+RE_5_1 = re.compile(r'll$')
+RE3_5 = re.compile('^' + _C + _v + '[^aeiouwxy]$')
+
+def _porter_stemmer(w):
+    if len(w) < 3:
+        return w
+
+    firstch = w[0]
+    if firstch == 'y':
+        w = 'Y' + w[1:]
+
+    # Step 1a
+    if RE_1A.search(w):
+        w = RE_1A.sub(r'\1\2', w, count=1)
+    elif RE2_1A.search(w):
+        w = RE2_1A.sub(r'\1\2', w, count=1)
+
+    # Step 1b
+    fp = RE_1B.search(w)
+    if fp:
+        if RE_MGR0.search(fp[1]):
+            w = w[:-1]
+    else:
+        fp = RE2_1B.search(w)
+        if fp and RE_S_V.search(fp[1]):
+            w = fp[1]
+            if RE2_1B_2.search(w):
+                w = w + 'e'
+            elif RE3_1B_2.search(w):
+                w = w[:-1]
+            elif RE4_1B_2.search(w):
+                w = w + 'e'
+
+    # Step 1c
+    fp = RE_1C.search(w)
+    if fp:
+        w = fp[1] + 'i'
+
+    # Step 2
+    fp = RE_2.search(w)
+    if fp and RE_MGR0.search(fp[1]):
+        w = fp[1] + STEP2[fp[2]]
+
+    # Step 3
+    fp = RE_3.search(w)
+    if fp and RE_MGR0.search(fp[1]):
+        w = fp[1] + STEP3[fp[2]]
+
+    # Step 4
+    fp = RE_4.search(w)
+    if fp:
+        if RE_MGR1.search(fp[1]):
+            w = fp[1]
+    else:
+        fp = RE2_4.search(w)
+        if fp and RE_MGR1.search(fp[1] + fp[2]):
+            w = fp[1] + fp[2]
+
+    # Step 5
+    fp = RE_5.search(w)
+    if fp:
+        stem = fp[1]
+        if RE_MGR1.search(stem) or (RE_MEQ1.search(stem) and not RE3_5.search(stem)):
+            w = stem
+
+    if RE_5_1.search(w) and RE_MGR1.search(w):
+        w = w[:-1]
+
+    # turn initial Y back to y
+    if firstch == 'y':
+        w = 'y' + w[1:]
+
+    return w
+
+def _utf16_units(s):
+    # JavaScript strings are UTF-16, so characters outside the BMP count (and match) as two code units
+    return ''.join(c if ord(c) < 0x10000 else chr(0xd800 + ((ord(c) - 0x10000) >> 10)) + chr(0xdc00 + ((ord(c) - 0x10000) & 0x3ff)) for c in s)
+
+def stem(word):
+    """Stem a word exactly as lunr.stemmer does."""
+    if word.isascii() or all(ord(c) < 0x10000 for c in word):
+        return _porter_stemmer(word)
+    return _porter_stemmer(_utf16_units(word)).encode('utf-16-le', 'surrogatepass').decode('utf-16-le')
+
+def tokenize(text):
+    """Split text into index terms, with lunr's tokenizer and default pipeline (trimmer, stop word filter, stemmer)."""
+    terms = []
+    for token in SEPARATOR.split(text.lower()):
+        if not token:
+            continue
+        token = TRIM_END.sub('', TRIM_START.sub('', token, count=1), count=1)
+        if token in STOP_WORDS:
+            continue
+        terms.append(stem(token))
+    return terms
+
+def shard_key(term):
+    """The shard a term is written to with sharding: its first character if that is a-z or 0-9, otherwise '_'."""
+    c = term[:1]
+    return c if ('a' <= c <= 'z' or '0' <= c <= '9') else '_'
+
+def _js_number(n):
+    # serialize like JSON.stringify: integral values without a fraction
+    return repr(n) if isinstance(n, float) and not n.is_integer() else str(int(n))
+
+def _js_round(n):
+    # Math.round: halves round up, not to even
+    r = math.floor(n)
+    return r + 1 if n - r >= 0.5 else r
+
+def _utf16_sort_key(term):
+    # Array.prototype.sort compares UTF-16 code units
+    return term.encode('utf-16-be', 'surrogatepass')
+
+class LunrIndexBuilder:
+    """
+    Incrementally builds a lunr index with a `link` ref and `title` and `body` fields.
+
+    `add()` tokenizes a document and keeps only its term frequencies; the BM25 field vectors are computed
+    when the index is written, since they depend on the document count and average field lengths.
+    With spill=True, the term frequencies are kept in a temporary file instead of in memory, and only the
+    postings (which make up the inverted index) stay in memory.
+    """
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self, fields=('title', 'body'), spill=False):
+        self.fields = list(fields)
+        self.document_count = 0
+        self.term_index = {}   # term -> term index (order of first appearance)
+        self.postings = []     # term index -> {field: {ref: None}}
+        self.field_terms = {}  # field ref ('field/ref') -> (field name, ref, field length, {term index: frequency})
+        # with spill, field_terms has (offset, count) of the frequencies' (term index, frequency) pairs in the file
+        self.spill = tempfile.TemporaryFile() if spill else None
+
+    def add(self, ref, **fields):
+        self.add_terms(ref, **{field: tokenize(fields.get(field) or '') for field in self.fields})
+
+    def add_terms(self, ref, **field_terms):
+        """Add a document whose fields have already been split into terms with tokenize()."""
+        self.document_count += 1
+        for field in self.fields:
+            terms = field_terms.get(field, [])
+            frequencies = {}
+            for term in terms:
+                index = self.term_index.get(term)
+                if index is None:
+                    index = self.term_index[term] = len(self.postings)
+                    self.postings.append({f: {} for f in self.fields})
+                frequencies[index] = frequencies.get(index, 0) + 1
+                self.postings[index][field][ref] = None
+            if self.spill:
+                pairs = array('L', (n for pair in frequencies.items() for n in pair))
+                frequencies = (self.spill.seek(0, 2), len(frequencies))
+                pairs.tofile(self.spill)
+            self.field_terms[f"{field}/{ref}"] = (field, ref, len(terms), frequencies)
+
+    def _frequencies(self, frequencies):
+        # the {term index: frequency} dict of a field_terms entry, read back from the spill file if need be
+        if not self.spill:
+            return frequencies
+        offset, count = frequencies
+        pairs = array('L')
+        self.spill.seek(offset)
+        pairs.fromfile(self.spill, 2 * count)
+        return dict(zip(pairs[::2], pairs[1::2]))
+
+    def _field_vectors(self, include=None):
+        # yield (field ref, [term index, score, ...]) in insertion order, optionally only for some term indexes
+        # (and then only the field refs those terms' postings refer to)
+        if include is not None:
+            needed = {f"{field}/{ref}" for index in include for field, refs in self.postings[index].items() for ref in refs}
+        lengths = {f: 0 for f in self.fields}
+        counts = {f: 0 for f in self.fields}
+        for field, ref, length, frequencies in self.field_terms.values():
+            lengths[field] += length
+            counts[field] += 1
+        average = {f: lengths[f] / counts[f] if counts[f] else 0 for f in self.fields}
+        idf_cache = {}
+        for field_ref, (field, ref, length, frequencies) in self.field_terms.items():
+            if include is not None and field_ref not in needed:
+                continue
+            vector = []
+            frequencies = self._frequencies(frequencies)
+            for index in sorted(frequencies):
+                if include is not None and index not in include:
+                    continue
+                tf = frequencies[index]
+                idf = idf_cache.get(index)
+                if idf is None:
+                    with_term = sum(len(refs) for refs in self.postings[index].values())
+                    x = (self.document_count - with_term + 0.5) / (with_term + 0.5)
+                    idf = idf_cache[index] = math.log(1 + abs(x))
+                score = idf * ((self.k1 + 1) * tf) / (self.k1 * (1 - self.b + self.b * (length / average[field])) + tf)
+                vector.append(index)
+                vector.append(_js_round(score * 1000) / 1000)
+            yield field_ref, vector
+
+    def _write(self, outfile, terms):
+        # stream the serialized index out entry by entry, formatted like JSON.stringify
+        dumps = lambda o: json.dumps(o, ensure_ascii=False, separators=(',', ':'))
+        include = None if terms is None else {self.term_index[t] for t in terms}
+        if terms is None:
+            terms = self.term_index
+        outfile.write('{"version":%s,"fields":%s,"fieldVectors":[' % (dumps(LUNR_VERSION), dumps(self.fields)))
+        for i, (field_ref, vector) in enumerate(self._field_vectors(include)):
+            outfile.write(('[%s,[%s]]' if i == 0 else ',[%s,[%s]]') % (dumps(field_ref), ','.join(_js_number(n) for n in vector)))
+        outfile.write('],"invertedIndex":[')
+        for i, term in enumerate(sorted(terms, key=_utf16_sort_key)):
+            index = self.term_index[term]
+            posting = {'_index': index}
+            posting.update((f, {ref: {} for ref in refs}) for f, refs in self.postings[index].items())
+            outfile.write(('[%s,%s]' if i == 0 else ',[%s,%s]') % (dumps(term), dumps(posting)))
+        outfile.write('],"pipeline":["stemmer"]}')
+
+    def write(self, outfile):
+        """Write the whole index as JSON."""
+        self._write(outfile, None)
+
+    def shards(self):
+        """Group the terms by shard_key(), returning {shard key: [terms]}."""
+        shards = {}
+        for term in self.term_index:
+            shards.setdefault(shard_key(term), []).append(term)
+        return dict(sorted(shards.items()))
+
+    def write_shard(self, outfile, terms):
+        """
+        Write a standalone index for some of the terms, with field vectors cut down to those terms.
+
+        lunr scores a document by the dot product of its field vectors with the query vector, divided by the
+        query vector's magnitude, so queries whose terms all fall in one shard score exactly as in the whole index.
+        """
+        self._write(outfile, terms)
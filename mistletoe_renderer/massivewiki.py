@@ -1,19 +1,17 @@
 """
 Massive Wiki support for mistletoe.
 """
-# set up logging
-import logging, os
-logging.basicConfig(level=os.environ.get('LOGLEVEL', 'WARNING').upper())
-
+from functools import lru_cache
 from itertools import chain
 from mistletoe import Document
 from mistletoe.span_token import SpanToken
 from mistletoe.html_renderer import HTMLRenderer
 from pathlib import Path
 import html
+import logging
 import re
 
-__all__ = ['DoubleSquareBracketLink', 'EmbeddedImageDoubleSquareBracketLink', 'TranscludedDoubleSquareBracketLink', 'MassiveWikiRenderer']
+__all__ = ['DoubleSquareBracketLink', 'EmbeddedImageDoubleSquareBracketLink', 'TranscludedDoubleSquareBracketLink', 'TransclusionCache', 'DocumentContext', 'MassiveWikiRenderer']
 
 class DoubleSquareBracketLink(SpanToken):
     """
@@ -50,91 +48,229 @@ class TranscludedDoubleSquareBracketLink(SpanToken):
     def __init__(self, match):
         self.target = match.group(1)
 
+class TransclusionCache:
+    """
+    Memoizes rendered transcluded pages, across all the documents rendered in a build.
+
+    Entries are keyed by the transcluded page's wikipage_id and whether it was rendered with paragraph tags
+    suppressed (as it is inside a tight list item), and record every page transcluded while
+    rendering it (as a dict of wikipage_id -> wikilink key), and the wikilink keys looked up (see
+    DocumentContext.lookups). An entry is only used when none of those are
+    in the current transclusion chain, so transclusion loops are reported exactly as if the page were
+    rendered afresh. If maxsize is set, only that many entries are kept, evicting the least recently used.
+    """
+    def __init__(self, maxsize=None):
+        self._entries = {}
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, wikipage_id, chain, suppress_ptag=False):
+        key = (wikipage_id, suppress_ptag)
+        entry = self._entries.get(key)
+        if entry and entry[1].keys().isdisjoint(chain):
+            self.hits += 1
+            if self.maxsize is not None:
+                # move to the end, the most recently used
+                self._entries[key] = self._entries.pop(key)
+            return entry
+        self.misses += 1
+        return None
+
+    def put(self, wikipage_id, html, depends_on, lookups=None, suppress_ptag=False):
+        self._entries[(wikipage_id, suppress_ptag)] = (html, depends_on, lookups or {})
+        if self.maxsize is not None and len(self._entries) > self.maxsize:
+            del self._entries[next(iter(self._entries))]
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+@lru_cache(maxsize=None)
+def _wikilink_key(inner):
+    # the wikilinks key for the rendered text of a link: its last path component, unescaped, lower case
+    # (memoized, as the same link texts are resolved over and over in a build)
+    return html.unescape(Path(inner).name).lower()
+
+class DocumentContext:
+    """
+    Per-document state for MassiveWikiRenderer: the document's file_id, the chain of pages being
+    transcluded (and for each, the pages transcluded inside it), the pages transcluded so far,
+    where to trace link resolution decisions, and how many links resolved or were incipient.
+
+    lookups holds, for the document and each page being transcluded, the wikilink keys looked up in the
+    link table while rendering it (wikilink key -> whether it was transcluded); lookups[0] is every key
+    the rendered document depends on, including those of transcluded pages, so a rendering can be reused
+    for as long as those keys resolve to the same entries (and transcluded pages are unchanged).
+    """
+    __slots__ = ('file_id', 'tc_chain', 'tc_depends_on', 'lookups', 'transclusions', 'trace', 'tracing', 'resolved', 'incipient')
+
+    def __init__(self, file_id='', trace=None):
+        self.file_id = file_id
+        self.tc_chain = [file_id]
+        self.tc_depends_on = [{}]
+        self.lookups = [{}]
+        self.transclusions = []
+        self.trace = trace
+        # resolution decisions are only worked out when someone is listening
+        self.tracing = trace is not None or logging.getLogger().isEnabledFor(logging.DEBUG)
+        self.resolved = 0
+        self.incipient = 0
+
 class MassiveWikiRenderer(HTMLRenderer):
     """
     Extends HTMLRenderer to handle double square bracket links.
 
+    A renderer can be kept for a whole build: call new_document() before rendering each document
+    to reset the per-document state, instead of constructing (and exiting) a renderer per document.
+    Its span tokens stay registered with mistletoe until the renderer is exited.
+
     Args:
         rootdir (string): directory path to prepend to all links, defaults to '/'.
+        wikilinks (dict): the link table: wikilink key -> {'fs_path', 'html_path', 'wikipage_id', ...} for every
+            page and file that links resolve to. An entry's 'href', if present, is used as the finished link
+            (it must equal rootdir plus html_path relative to rootdir); otherwise that is worked out per link.
         fileroot (string): local filesystem path to the root of the wiki, so we can read transcluded pages.
+        read_page (callable): takes a page's fs_path and returns its Markdown text, for transclusion;
+            defaults to reading the file under fileroot.
+        transclusion_cache (TransclusionCache): share rendered transcluded pages between renderers.
+        trace (list): if given, a dict describing how each wikilink, embedded image, and transclusion
+            was resolved is appended to it. The same dicts are logged when debug logging is on.
 
     Properties:
         links (array of strings, read-only): all of the double square bracket link targets found in this invocation.
+        transclusions (array of strings): wikilink keys of all the pages transcluded into the current document, directly or indirectly.
     """
-    def __init__(self, rootdir='/', fileroot='.', wikilinks={}, file_id=''):
+    def __init__(self, rootdir='/', fileroot='.', wikilinks={}, file_id='', read_page=None, transclusion_cache=None, trace=None):
         super().__init__(*chain([TranscludedDoubleSquareBracketLink,EmbeddedImageDoubleSquareBracketLink,DoubleSquareBracketLink]))
         self._rootdir = rootdir
         self._fileroot = fileroot
         self._wikilinks = wikilinks
-        self._file_id = file_id
-        self._tc_dict = dict.fromkeys([self._file_id], [])
-        self._tc_dict[self._file_id].append(self._file_id)
+        self._read_page = read_page or self._read_page_file
+        self._tc_cache = transclusion_cache
+        self.new_document(file_id, trace)
 
-    def render_double_square_bracket_link(self, token):
-        logging.debug("WIKILINKED token: %s", token)
-        target = token.target
-        logging.debug("WIKILINKED token.target: %s", token.target)
-        logging.debug("WIKILINKED inner(token): %s", self.render_inner(token))
-        wikilink_key = html.unescape(Path(self.render_inner(token)).name).lower()
-        logging.debug("WIKILINKED wikilink_key: %s", wikilink_key)
-        wikilink_value = self._wikilinks.get(wikilink_key, None)
-        logging.debug("WIKILINKED wikilink_value: %s", wikilink_value)
+    def new_document(self, file_id='', trace=None):
+        """
+        Reset per-document state before rendering another document.
+
+        Args:
+            file_id (string): wikipage_id of the document, so it can't be transcluded into itself.
+            trace (list): if given, link resolution decisions for this document are appended to it.
+
+        Returns the new DocumentContext.
+        """
+        self._doc = DocumentContext(file_id, trace)
+        self._suppress_ptag_stack = [False]
+        self.footnotes = {}
+        return self._doc
+
+    @property
+    def transclusions(self):
+        return self._doc.transclusions
+
+    def _resolve(self, wikilink_key, transcluded=False):
+        # look up a wikilink key in the link table, counting hits and misses for the document
+        self._add_lookups({wikilink_key:transcluded})
+        wikilink_value = self._wikilinks.get(wikilink_key)
         if wikilink_value:
-            inner = Path(wikilink_value['html_path']).relative_to(self._rootdir).as_posix()
-            template = '<a class="wikilink" href="{rootdir}{inner}">{target}</a>'
+            self._doc.resolved += 1
         else:
-            inner = self.render_inner(token)
-            template = '<span class="incipient-wikilink">{target}</span>'
-        logging.debug("WIKILINKED inner: %s", inner)
-        return template.format(target=target, inner=inner, rootdir=self._rootdir)
+            self._doc.incipient += 1
+        return wikilink_value
+
+    def _href(self, wikilink_value):
+        href = wikilink_value.get('href')
+        if href is None:
+            href = self._rootdir + Path(wikilink_value['html_path']).relative_to(self._rootdir).as_posix()
+        return href
+
+    def render_double_square_bracket_link(self, token):
+        target = token.target
+        wikilink_key = _wikilink_key(self.render_inner(token))
+        wikilink_value = self._resolve(wikilink_key)
+        href = self._href(wikilink_value) if wikilink_value else None
+        if self._doc.tracing:
+            self._trace('wikilink', target=target, key=wikilink_key, resolved=bool(wikilink_value), href=href)
+        if href is None:
+            return f'<span class="incipient-wikilink">{target}</span>'
+        return f'<a class="wikilink" href="{href}">{target}</a>'
 
     def render_embedded_image_double_square_bracket_link(self, token):
-        logging.debug("EMBEDDED token: %s", token)
-        template = '<img src="{rootdir}{inner}" alt="{target}" />'
         target = token.target
         if not target:
             target = "an image with no alt text"
-        logging.debug("EMBEDDED token.target: %s", token.target)
-        logging.debug("EMBEDDED token.content: %s", token.content)
-        logging.debug("EMBEDDED inner(token): %s", self.render_inner(token))
         wikilink_key = token.content.lower()
-        wikilink_value = self._wikilinks.get(wikilink_key, None)
-        logging.debug("EMBEDDED wikilink_key: %s", wikilink_key)
-        logging.debug("EMBEDDED wikilink_value: %s", wikilink_value)
-        if wikilink_value:
-            inner = Path(wikilink_value['html_path']).relative_to(self._rootdir).as_posix()
-        else:
-            inner = token.content
-        logging.debug("EMBEDDED inner: %s", inner)
-        return template.format(target=target, inner=inner, rootdir=self._rootdir)
+        wikilink_value = self._resolve(wikilink_key)
+        href = self._href(wikilink_value) if wikilink_value else self._rootdir + token.content
+        if self._doc.tracing:
+            self._trace('image', target=token.content, key=wikilink_key, resolved=bool(wikilink_value), href=href)
+        return f'<img src="{href}" alt="{target}" />'
 
     def render_transcluded_double_square_bracket_link(self, token):
-        logging.debug("TRANSCLUDED file_id: %s", self._file_id)
-        logging.debug("TRANSCLUDED fileroot: %s", self._fileroot)        
-        logging.debug("TRANSCLUDED token: %s", token)
         target = token.target
-        logging.debug("TRANSCLUDED token.target: %s", token.target)
         inner = self.render_inner(token)
-        logging.debug("TRANSCLUDED inner(token): %s", self.render_inner(token))
-        wikilink_key = html.unescape(Path(self.render_inner(token)).name).lower()
-        logging.debug("TRANSCLUDED wikilink_key: %s", wikilink_key)
-        wikilink_value = self._wikilinks.get(wikilink_key, None)
-        logging.debug("TRANSCLUDED wikilink_value: %s", wikilink_value)
+        wikilink_key = _wikilink_key(inner)
+        wikilink_value = self._resolve(wikilink_key, transcluded=True)
+        loop = cached = False
         if wikilink_value:
-            logging.debug("TRANSCLUDED wikipage_id: %s", wikilink_value['wikipage_id'])
-            if any(wikilink_value['wikipage_id'] in x for x in self._tc_dict[self._file_id]):
-                logging.debug("*** ruh roh! there is a transclude loop")
+            wikipage_id = wikilink_value['wikipage_id']
+            self._add_transclusions({wikipage_id:wikilink_key})
+            loop = wikipage_id in self._doc.tc_chain
+            if loop:
                 template = '<p><span class="transclusion-error">Cannot transclude <strong>{inner}</strong> within itself.</span></p>'
             else:
-                self._tc_dict[self._file_id].append(wikilink_value['wikipage_id'])
-                logging.debug("TRANSCLUDED _tc_dict: %s", self._tc_dict)
-                transclude_path = f"{self._fileroot}{wikilink_value['fs_path']}"
-                logging.debug(f"TRANSCLUDED loading contents of '{transclude_path}'")
-                with open(transclude_path, 'r') as infile: inner = infile.read()
-                rendered_doc = self.render(Document(inner))
+                rendered_doc, cached = self._render_transcluded_page(wikipage_id, wikilink_value)
                 htmlpath = wikilink_value['html_path']
                 template = f'<p><a href="{htmlpath}" style="float:right">🔗</a> {rendered_doc} </p>'
         else:
             template = '<p><span class="transclusion-error">TRANSCLUSION {target} NOT FOUND</span></p>'
+        if self._doc.tracing:
+            self._trace('transclusion', target=target, key=wikilink_key, resolved=bool(wikilink_value), loop=loop, cached=cached, depth=len(self._doc.tc_chain)-1)
         return template.format(target=target, inner=inner, rootdir=self._rootdir)
 
+    def _trace(self, token_type, **decision):
+        decision = dict(token=token_type, file_id=self._doc.file_id, **decision)
+        logging.debug("%s", decision)
+        if self._doc.trace is not None:
+            self._doc.trace.append(decision)
+
+    def _add_transclusions(self, depends_on):
+        self._doc.tc_depends_on[-1].update(depends_on)
+        for wikilink_key in depends_on.values():
+            if wikilink_key not in self._doc.transclusions:
+                self._doc.transclusions.append(wikilink_key)
+
+    def _add_lookups(self, lookups):
+        current = self._doc.lookups[-1]
+        for wikilink_key, transcluded in lookups.items():
+            current[wikilink_key] = current.get(wikilink_key, False) or transcluded
+
+    def _read_page_file(self, fs_path):
+        with open(f"{self._fileroot}{fs_path}", 'r') as infile:
+            return infile.read()
+
+    def _render_transcluded_page(self, wikipage_id, wikilink_value):
+        # paragraphs render without <p> tags in tight list items, so that is part of the cache key
+        suppress_ptag = self._suppress_ptag_stack[-1]
+        cached = self._tc_cache.get(wikipage_id, self._doc.tc_chain, suppress_ptag) if self._tc_cache else None
+        if cached:
+            rendered_doc, depends_on, lookups = cached
+            self._add_transclusions(depends_on)
+            self._add_lookups(lookups)
+            return rendered_doc, True
+        inner = self._read_page(wikilink_value['fs_path'])
+        self._doc.tc_chain.append(wikipage_id)
+        self._doc.tc_depends_on.append({})
+        self._doc.lookups.append({})
+        rendered_doc = self.render(Document(inner))
+        depends_on = self._doc.tc_depends_on.pop()
+        lookups = self._doc.lookups.pop()
+        self._doc.tc_chain.pop()
+        self._doc.tc_depends_on[-1].update(depends_on)
+        self._add_lookups(lookups)
+        # only cache pages whose rendering didn't depend on where in the chain they were transcluded
+        if self._tc_cache and depends_on.keys().isdisjoint(self._doc.tc_chain):
+            self._tc_cache.put(wikipage_id, rendered_doc, depends_on, lookups, suppress_ptag)
+        return rendered_doc, False
@@ -1,5 +1,9 @@
 #!/usr/bin/env python
 
+# set up logging
+import logging, os
+logging.basicConfig(level=os.environ.get('LOGLEVEL', 'WARNING').upper())
+
 import sys
 
 from mistletoe import Document
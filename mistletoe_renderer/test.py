@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 from mistletoe import Document
-from massivewiki import MassiveWikiRenderer
+from massivewiki import MassiveWikiRenderer, TransclusionCache
 
 test_strings = [
     [ '[[test]]', '<p><a class="wikilink" href="/test">test</a></p>\n' ],
@@ -23,3 +23,22 @@ for pair in test_strings:
         else:
             print(f'FAIL\nexpected: »{pair[1]}«\ngot: »{result}«')
 
+
+# a page transcluded into a tight list item (rendered without <p> tags) and then into a paragraph,
+# sharing a transclusion cache, renders the same as without the cache
+snippet_pages = {'/Snippet.md': 'hello\n\nworld'}
+snippet_links = {'snippet': {'fs_path': '/Snippet.md', 'html_path': '/Snippet.html', 'wikipage_id': 'snippet-id'}}
+transclusion_strings = [
+    [ '- ![[Snippet]]\n- item two', '<ul>\n<li><p><a href="/Snippet.html" style="float:right">🔗</a> hello\nworld\n </p></li>\n<li>item two</li>\n</ul>\n' ],
+    [ 'Intro\n\n![[Snippet]]', '<p>Intro</p>\n<p><p><a href="/Snippet.html" style="float:right">🔗</a> <p>hello</p>\n<p>world</p>\n </p></p>\n' ],
+]
+
+with MassiveWikiRenderer(wikilinks=snippet_links, read_page=snippet_pages.get, transclusion_cache=TransclusionCache()) as renderer:
+    for pair in transclusion_strings:
+        renderer.new_document()
+        result = renderer.render(Document(pair[0]))
+        print(pair[0].replace('\n', '\\n'), ' ... ', end='')
+        if result == pair[1]:
+            print('pass')
+        else:
+            print(f'FAIL\nexpected: »{pair[1]}«\ngot: »{result}«')
@@ -10,39 +10,103 @@
 APPVERSION = 'v3.2.1-candidate'
 APPNAME = 'Massive Wiki Builder'
 
+# bump MANIFEST_VERSION whenever the manifest format changes; a mismatch forces a full rebuild
+MANIFEST_VERSION = 3
+MANIFEST_FILENAME = '.mwb-manifest.json'
+
+# --profile writes its report to this file in the output directory, listing this many of the slowest pages
+PROFILE_FILENAME = 'build-profile.json'
+PROFILE_SLOWEST_PAGES = 20
+
+# with --compress, output files with these suffixes get compressed copies (text formats; images, audio, video,
+# and archives are compressed already), unless they are smaller than COMPRESS_MIN_SIZE bytes
+COMPRESSIBLE_SUFFIXES = {'.html', '.htm', '.json', '.js', '.mjs', '.css', '.svg', '.txt', '.md', '.xml', '.csv', '.map'}
+COMPRESS_MIN_SIZE = 1024
+
+# with --low-memory, each rendering process keeps at most this many rendered transcluded pages
+LOW_MEMORY_TRANSCLUSION_CACHE_SIZE = 1000
+
 # set up logging
 import logging, os
 logging.basicConfig(level=os.environ.get('LOGLEVEL', 'WARNING').upper())
 
 # python libraries
+# (modules that only some builds need, like mistletoe, concurrent.futures, and dateutil, are imported where they are used,
+# so starting up, and builds that don't need them, don't wait for them)
 import argparse
 import datetime
+import fnmatch
+import functools
 import glob
 import hashlib
+import heapq
+import itertools
 import json
 from pathlib import Path
 import re
 import shutil
 import subprocess
 import sys
+import tempfile
 import textwrap
 import time
 import traceback
 
 # pip install
-from dateutil.parser import parse # pip install python-dateutil
 import jinja2
 import yaml
 
-# pip install - mistletoe based Markdown to HTML conversion
-from mistletoe import Document
-from mistletoe_renderer.massivewiki import MassiveWikiRenderer
-
 wiki_pagelinks = {}
+wiki_pages = {} # ingested Markdown pages, by fs_path - see ingest_page()
+renderer = None # one MassiveWikiRenderer per process, set up by the first markdown_convert()
+transclusion_cache = None # rendered transcluded pages, shared by every page rendered in this process (set up with renderer)
+Document = None # mistletoe's Document, imported with renderer
+
+# set up this process's renderer
+# mistletoe takes a large part of a second to import, so it is only imported once there is Markdown to render
+def init_renderer(fileroot):
+    global renderer, transclusion_cache, Document
+    # pip install - mistletoe based Markdown to HTML conversion
+    from mistletoe import Document
+    from mistletoe_renderer.massivewiki import MassiveWikiRenderer, TransclusionCache
+    transclusion_cache = TransclusionCache(transclusion_cache_size())
+    renderer = MassiveWikiRenderer(rootdir='/',fileroot=fileroot,wikilinks=wiki_pagelinks,read_page=page_text,transclusion_cache=transclusion_cache)
+
+# return HTML, and the wikilink keys of the pages transcluded into it
+# if trace is a list, link resolution decisions are appended to it
+# if timings is a dict, the seconds spent parsing and rendering are stored in it, with the number of links that resolved and that were incipient
+# if lookups is a dict, the wikilink keys the HTML depends on are stored in it (see DocumentContext.lookups)
+def markdown_convert(markdown_text, fileroot, file_id, trace=None, timings=None, lookups=None):
+    if renderer is None:
+        timed('setup', init_renderer, fileroot) # (not the stage that happens to render first)
+    document = renderer.new_document(file_id, trace)
+    if timings is None:
+        html = renderer.render(Document(markdown_text))
+    else:
+        start = time.perf_counter()
+        parsed = Document(markdown_text)
+        parsed_at = time.perf_counter()
+        html = renderer.render(parsed)
+        timings['parse'] = parsed_at - start
+        timings['render'] = time.perf_counter() - parsed_at
+        timings['links_resolved'] = document.resolved
+        timings['links_incipient'] = document.incipient
+    if lookups is not None:
+        lookups.update(document.lookups[0])
+    return html, document.transclusions
+
+# read the text of a Markdown wiki page
+def read_page_text(file):
+    with open(file, encoding='utf-8') as infile:
+        return infile.read()
+
+# get the text of an ingested wiki page, reading it again if --low-memory dropped it
+def ingested_text(page):
+    return page['text'] if page['text'] is not None else read_page_text(page['file'])
 
-def markdown_convert(markdown_text, fileroot, file_id):
-    with MassiveWikiRenderer(rootdir='/',fileroot=fileroot,wikilinks=wiki_pagelinks,file_id=file_id) as renderer:
-        return renderer.render(Document(markdown_text))
+# get the text of an ingested wiki page by fs_path (used for transclusion)
+def page_text(fs_path):
+    return ingested_text(wiki_pages[fs_path])
 
 # set up argparse
 def init_argparse():
@@ -51,14 +115,66 @@ def init_argparse():
     parser.add_argument('--output', '-o', required=True, help='directory for output')
     parser.add_argument('--templates', '-t', required=True, help='directory for HTML templates')
     parser.add_argument('--wiki', '-w', required=True, help='directory containing wiki files (Markdown + other)')
-    parser.add_argument('--lunr', action='store_true', help='include this to create lunr index (requires npm and lunr to be installed, read docs)')
+    parser.add_argument('--lunr', action='store_true', help='include this to create lunr index')
+    parser.add_argument('--lunr-shards', action='store_true', help='with --lunr, split the lunr index into shards by the first character of each term, so browsers only load the shards a search needs')
     parser.add_argument('--commits', action='store_true', help='include this to read Git commit messages and times, for All Pages')
+    parser.add_argument('--cache-dir', help='directory for caches kept between builds (default: .mwb-cache next to the output directory); compiled templates are only cached when it is given')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='number of worker processes for rendering pages (0 = one per CPU, default 1)')
+    parser.add_argument('--trace', metavar='FILE', help='write how every wikilink, embedded image, and transclusion was resolved to FILE, one JSON object per line')
+    parser.add_argument('--incremental', action='store_true', help='only re-render pages affected by changes since the last incremental build (keeps a manifest in the output directory)')
+    parser.add_argument('--copy-mode', choices=['copy', 'hardlink', 'reflink', 'skip-unchanged'], default='copy', help="how to put attachments and static files in the output directory: 'copy' (default), 'hardlink', 'reflink' (copy-on-write clone where supported, else copy), or 'skip-unchanged' (only copy files whose size or mtime changed since the previous build)")
+    parser.add_argument('--profile', action='store_true', help=f'time each stage of the build and each page, and write the results to {PROFILE_FILENAME} in the output directory')
+    parser.add_argument('--changed-files', metavar='FILE', help='write the paths (relative to the output directory) of the output files this build added, changed, or removed to FILE, one per line, e.g. for `rsync --files-from=FILE --delete-missing-args`')
+    parser.add_argument('--low-memory', action='store_true', help='keep memory use bounded for very large wikis: keep only the link index in memory, read page text again when rendering, and spill the lunr and All Pages data to temporary files')
+    parser.add_argument('--watch', action='store_true', help='after building, watch the wiki, templates, and config for changes, rebuild what they affect, and serve the output directory with live reload')
+    parser.add_argument('--compress', nargs='+', choices=['gzip', 'br'], help="write compressed copies of text output files next to them, for servers that serve precompressed files: 'gzip' (.gz) and/or 'br' (.br, needs `pip install brotli`)")
+    parser.add_argument('--render-cache', metavar='DIR', help='keep the HTML rendered from each page in DIR, and reuse it when the page and the pages it links to or transcludes are the same; builds of different branches (even at the same time) can share DIR')
+    parser.add_argument('--render-cache-size', metavar='MB', type=int, default=1000, help='with --render-cache, evict the least recently used renderings when the cache grows past MB megabytes (default 1000)')
+    parser.add_argument('--fragments', action='store_true', help='write the sidebar once, to a file that every page loads, instead of into every page')
+    parser.add_argument('--compile-theme', action='store_true', help=f'before building, compile the templates of the theme into {COMPILED_TEMPLATES} in the theme directory, which later builds load instead of the template sources while it is up to date')
+    parser.add_argument('--port', type=int, default=8000, help='with --watch, the port to serve the output directory on (default 8000)')
     return parser
 
+# precompiled templates of a theme (see --compile-theme), in the theme directory
+COMPILED_TEMPLATES = 'compiled-templates.zip'
+
+# the files of a theme that are templates, by their Jinja2 template names (static files are copied, not rendered)
+def theme_templates(path_to_templates):
+    return [name for name in jinja2.FileSystemLoader(path_to_templates).list_templates()
+            if name.split('/')[0] not in ('static', 'mwb-static', COMPILED_TEMPLATES) and
+               not any(part.startswith('.') for part in name.split('/'))]
+
+# compile the templates of a theme into a module bundle, COMPILED_TEMPLATES in the theme directory
+def compile_theme(path_to_templates):
+    names = set(theme_templates(path_to_templates))
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(path_to_templates))
+    env.compile_templates(Path(path_to_templates) / COMPILED_TEMPLATES, filter_func=lambda name: name in names,
+                          log_function=logging.debug)
+    logging.info("compiled %s templates into %s", len(names), Path(path_to_templates) / COMPILED_TEMPLATES)
+
 # set up a Jinja2 environment
-def jinja2_environment(path_to_templates):
+# one per process and templates directory, so --watch rebuilds reuse its compiled templates
+# (watch() discards it when the templates change); templates come from the theme's COMPILED_TEMPLATES if it is
+# newer than all of them, otherwise they are compiled from source, through a bytecode cache in bytecode_cache_dir
+# if there is one
+@functools.lru_cache(maxsize=None)
+def jinja2_environment(path_to_templates, bytecode_cache_dir):
+    loader = jinja2.FileSystemLoader(path_to_templates)
+    bundle = Path(path_to_templates) / COMPILED_TEMPLATES
+    if bundle.exists():
+        newest = max((os.path.getmtime(Path(path_to_templates) / name) for name in theme_templates(path_to_templates)), default=0)
+        if os.path.getmtime(bundle) >= newest:
+            loader = jinja2.ChoiceLoader([jinja2.ModuleLoader(bundle.as_posix()), loader])
+        else:
+            logging.warning("%s is older than the theme's templates, so it is not used - run with --compile-theme to update it", bundle)
+    bytecode_cache = None
+    if bytecode_cache_dir:
+        os.makedirs(bytecode_cache_dir, exist_ok=True)
+        bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_cache_dir)
     return jinja2.Environment(
-        loader=jinja2.FileSystemLoader(path_to_templates)
+        loader=loader,
+        bytecode_cache=bytecode_cache,
+        auto_reload=False,
     )
 
 # load config file
@@ -66,54 +182,861 @@ def load_config(path):
     with open(path) as infile:
         return yaml.safe_load(infile)
 
+# find the files in the wiki, skipping hidden files and directories (such as .git), and files and directories
+# matching one of the ignore patterns (fnmatch patterns, matched against the name and against the path from
+# the wiki root, e.g. 'node_modules' or 'drafts/*.md')
+# return their paths in a fixed order: the files of each directory, by name, then those of its subdirectories, by name
+# (os.scandir() reads the file types with the directory, so this needs no stat() of each file)
+def discover_files(dir_wiki, ignore=()):
+    ignored = re.compile('|'.join(fnmatch.translate(pattern) for pattern in ignore)).match if ignore else lambda name: False
+    files = []
+    directories = [(dir_wiki, '')]
+    while directories:
+        directory, relative = directories.pop()
+        subdirectories = []
+        with os.scandir(directory) as entries:
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                path = relative + entry.name
+                if entry.name.startswith('.') or ignored(entry.name) or ignored(path):
+                    continue
+                if entry.is_dir():
+                    subdirectories.append((entry.path, path + '/'))
+                elif entry.is_file():
+                    files.append(entry.path)
+        directories.extend(reversed(subdirectories))
+    return files
+
 # scrub wiki path to handle ' ', '_', '?', '"', '#', '%' characters in wiki page names
 # change those characters to '_' to avoid URL generation errors
 def scrub_path(filepath):
     return re.sub(r'([ _?\#%"]+)', '_', filepath)
 
-# find outgoing wikilinks in a wiki page
-def find_tolinks(file):
-    with open(file, 'r', encoding='utf-8') as infile:
-        pagetext = infile.read()
+# find outgoing wikilinks in the text of a wiki page
+def find_tolinks_in_text(pagetext):
     # use negative lookbehind assertion to exclude '![[' links
     wikilink_pattern = re.compile(r"(?<!!)\[\[ *(.+?) *(\| *.+?)? *\]\]")
     to_links = [p[0] for p in wikilink_pattern.findall(pagetext)]
     return to_links
 
+# find transcluded pages and embedded images in the text of a wiki page
+# return them as wiki_pagelinks keys
+def find_transclusions_in_text(pagetext):
+    transclusion_pattern = re.compile(r"!\[\[ *(.+?) *(\| *.+?)? *\]\]")
+    return [Path(p[0]).name.lower() for p in transclusion_pattern.findall(pagetext)]
+
+# wiki_pagelinks key for a wiki file: lowercased stem for Markdown pages, lowercased name otherwise
+def wiki_key(path):
+    if Path(path).suffix == '.md':
+        return Path(path).stem.lower()
+    return Path(path).name.lower()
+
 # take a path object pointing to a Markdown file
 # return Markdown (as string) and YAML front matter (as dict)
 # for YAML, {} = no front matter, False = YAML syntax error
 def read_markdown_and_front_matter(path):
     with path.open(encoding='utf-8') as infile:
-        lines = infile.readlines()
+        text = infile.read()
+    markdown_start, front_matter = parse_front_matter(text)
+    return text[markdown_start:], front_matter
+
+# the line that closes the front matter
+FRONT_MATTER_END = re.compile(r'^---$', re.MULTILINE)
+
+# safe YAML loader, using libyaml (much faster than the pure-Python loader) where PyYAML was built with it
+YAML_SAFE_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# a front matter line parse_flat_front_matter() can handle: `key: value`, where YAML can only read the key and
+# value as strings - they start with a letter (or the key with '_') and have no characters that mean anything to YAML
+FLAT_FRONT_MATTER_LINE = re.compile(r"([A-Za-z_][\w-]*):[ ]+([A-Za-z](?:[\w .,/()'?+=-]*[\w.,/()'?+=-])?)")
+# plain words YAML reads as booleans or null rather than strings
+YAML_KEYWORDS = {'yes', 'no', 'true', 'false', 'on', 'off', 'null'}
+
+# parse front matter made only of flat `key: value` string lines, much faster than YAML
+# return the same dict as YAML would, or None if the front matter isn't that simple
+def parse_flat_front_matter(text):
+    front_matter = {}
+    for line in text.splitlines():
+        match = FLAT_FRONT_MATTER_LINE.fullmatch(line)
+        if not match or match[1].lower() in YAML_KEYWORDS or match[2].lower() in YAML_KEYWORDS:
+            return None
+        front_matter[match[1]] = match[2]
+    return front_matter or None
+
+# take the text of a Markdown file
+# return the offset where the Markdown starts and YAML front matter (as dict)
+# for YAML, {} = no front matter, False = YAML syntax error
+def parse_front_matter(text):
     # take care to look exactly for two `---` lines with valid YAML in between
-    if lines and re.match(r'^---$',lines[0]):
-        count = 0
-        found_front_matter_end = False
-        for line in lines[1:]:
-            count += 1
-            if re.match(r'^---$',line):
-                found_front_matter_end = True
-                break;
-        if found_front_matter_end:
+    if text.startswith('---\n'):
+        front_matter_end = FRONT_MATTER_END.search(text, 4)
+        if front_matter_end:
+            front_matter_text = text[4:front_matter_end.start()]
             try:
-                front_matter = yaml.safe_load(''.join(lines[1:count]))
+                front_matter = parse_flat_front_matter(front_matter_text)
+                if front_matter is None:
+                    front_matter = yaml.load(front_matter_text, Loader=YAML_SAFE_LOADER)
             except (yaml.parser.ParserError, yaml.scanner.ScannerError):
-                # return Markdown + False (YAML syntax error)
-                return ''.join(lines), False
-            # return Markdown + front_matter
-            return ''.join(lines[count+1:]), front_matter
-    # return Markdown + empty dict
-    return ''.join(lines), {}
+                # Markdown is the whole text + False (YAML syntax error)
+                return 0, False
+            # Markdown starts after the closing `---` line + front_matter
+            return min(front_matter_end.end()+1, len(text)), front_matter
+    # Markdown is the whole text + empty dict
+    return 0, {}
+
+# read a Markdown wiki page once, and keep what later stages need from it:
+# text (for lunr and transclusion), where the Markdown starts and front matter (for rendering and abstracts),
+# outgoing wikilinks (for backlinks), transclusions, and its wiki_pagelinks key
+def ingest_page(file):
+    text = read_page_text(file)
+    markdown_start, front_matter = parse_front_matter(text)
+    return {
+        'key':wiki_key(file),
+        'text':text,
+        'markdown_start':markdown_start,
+        'front_matter':front_matter,
+        'links':find_tolinks_in_text(text),
+        'transclusions':find_transclusions_in_text(text),
+    }
 
 # read and convert Sidebar markdown to HTML
-def sidebar_convert_markdown(path, fileroot):
-    if path.exists():
+# use the ingested page if there is one
+def sidebar_convert_markdown(path, fileroot, page=None):
+    if page:
+        markdown_text = ingested_text(page)[page['markdown_start']:]
+    elif path.exists():
         markdown_text, front_matter = read_markdown_and_front_matter(path)
     else:
         markdown_text = ''
     fid = hashlib.md5(Path(path).stem.lower().encode()).hexdigest()
-    return markdown_convert(markdown_text, fileroot, fid)
+    return markdown_convert(markdown_text, fileroot, fid)[0]
+
+# the finished link to a wiki_pagelinks entry, worked out once so the renderer doesn't for every wikilink
+def wikilink_href(rootdir, html_path):
+    return rootdir + Path(html_path).relative_to(rootdir).as_posix()
+
+# HTML that loads the fragment file at sitepath in place of itself, for --fragments
+def fragment_loader(sitepath):
+    return (f'<div data-mwb-fragment="{sitepath}"></div><script>(function (placeholder) {{'
+            ' fetch(placeholder.getAttribute("data-mwb-fragment"))'
+            '.then(function (response) { return response.text(); })'
+            '.then(function (html) { placeholder.outerHTML = html; });'
+            ' })(document.currentScript.previousElementSibling);</script>')
+
+# wiki_pagelinks key for the target of a wikilink
+@functools.lru_cache(maxsize=None)
+def link_key(link):
+    return Path(link).name.lower()
+
+class LinkGraph:
+    """
+    Wikilink graph between the files in wiki_pagelinks.
+
+    Every wiki_pagelinks key gets an integer ID. Links are kept as forward and reverse adjacency lists,
+    in the order they were first seen, and deduplicated with a set of (from, to) ID pairs.
+    Links to targets that are not in the wiki are kept as incipient links.
+    """
+    def __init__(self, pagelinks):
+        self._pagelinks = pagelinks
+        self.keys = list(pagelinks)
+        self.ids = {key:i for i,key in enumerate(self.keys)}
+        self.titles = [None] * len(self.keys)
+        self.forward = [[] for _ in self.keys]
+        self.reverse = [[] for _ in self.keys]
+        self.incipient = [[] for _ in self.keys]
+        self.transcluded = [[] for _ in self.keys]
+        self._edges = set()
+        self._incipient_edges = set()
+
+    def add_page(self, key, title, links):
+        source = self.ids[key]
+        if self.titles[source] is None:
+            self.titles[source] = title
+        for link in links:
+            target = self.ids.get(link_key(link))
+            if target is None:
+                if (source, link) not in self._incipient_edges:
+                    self._incipient_edges.add((source, link))
+                    self.incipient[source].append(link)
+            elif (source, target) not in self._edges:
+                logging.debug("on page %s add backlink to page %s", self.keys[target], self._pagelinks[key]['html_path'])
+                self._edges.add((source, target))
+                self.forward[source].append(target)
+                self.reverse[target].append(source)
+
+    # record the pages transcluded (directly or indirectly) into a page when it was rendered
+    def add_transclusions(self, key, transcluded_keys):
+        source = self.ids[key]
+        for target in (self.ids[k] for k in transcluded_keys if k in self.ids):
+            if target not in self.transcluded[source]:
+                self.transcluded[source].append(target)
+
+    # (html path, title) of the pages linking to key, in the order the links were found
+    def backlinks(self, key):
+        return [(self._pagelinks[self.keys[source]]['html_path'], self.titles[source]) for source in self.reverse[self.ids[key]]]
+
+    # keys of pages that no other page links to
+    def orphans(self):
+        return [self.keys[i] for i,title in enumerate(self.titles)
+                if title is not None and not any(source != i for source in self.reverse[i])]
+
+    # incipient (broken) links, as (from key, link text) pairs
+    def incipient_links(self):
+        return [(self.keys[source], link) for source,links in enumerate(self.incipient) for link in links]
+
+    # number of outgoing and incoming links for key
+    def link_counts(self, key):
+        i = self.ids[key]
+        return len(self.forward[i]), len(self.reverse[i])
+
+    def to_dict(self):
+        html_path = lambda i: self._pagelinks[self.keys[i]]['html_path']
+        return {
+            'pages':[{
+                'id':i,
+                'path':html_path(i),
+                'title':self.titles[i],
+                'links_out':len(self.forward[i]),
+                'links_in':len(self.reverse[i]),
+            } for i in range(len(self.keys)) if self.titles[i] is not None],
+            'files':[{'id':i, 'path':html_path(i)} for i in range(len(self.keys)) if self.titles[i] is None],
+            'links':[[source, target] for source,targets in enumerate(self.forward) for target in targets],
+            'orphans':[self._pagelinks[key]['html_path'] for key in self.orphans()],
+            'incipient':[{'from':self._pagelinks[key]['html_path'], 'link':link} for key,link in self.incipient_links()],
+            'transclusions':[[source, target] for source,targets in enumerate(self.transcluded) for target in targets],
+        }
+
+# hash the contents of every file in a directory tree (used to notice theme changes)
+def tree_hash(path):
+    tree_md5 = hashlib.md5()
+    for file in sorted(glob.iglob(f"{path}/**/*", recursive=True)):
+        if os.path.isfile(file):
+            tree_md5.update(Path(file).relative_to(path).as_posix().encode())
+            tree_md5.update(Path(file).read_bytes())
+    return tree_md5.hexdigest()
+
+# load the build manifest written by the previous incremental build
+# return None if there is no usable manifest (missing, unreadable, or a different format version)
+def load_manifest(path):
+    try:
+        with open(path, encoding='utf-8') as infile:
+            manifest = json.load(infile)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        logging.info("manifest version %s does not match %s, doing a full build", manifest.get('version'), MANIFEST_VERSION)
+        return None
+    return manifest
+
+def save_manifest(path, manifest):
+    with open(path, 'w', encoding='utf-8') as outfile:
+        json.dump(manifest, outfile)
+
+# record a wiki file's mtime, size, and content hash, plus outgoing wikilinks and transclusions for Markdown files
+# the previous manifest entry is reused as-is if mtime and size have not changed
+# Markdown files are hashed from their ingested page rather than read again (unless --low-memory dropped its text)
+# if only the mtime changed (e.g. `touch` or `git checkout`), the page won't be re-rendered, so its All Pages entry
+# and transcluded pages are kept from the previous entry
+def source_state(file, previous=None, page=None):
+    stat = os.stat(file)
+    if previous and previous['mtime'] == stat.st_mtime_ns and previous['size'] == stat.st_size:
+        return previous
+    content = page['text'].encode('utf-8') if page and page['text'] is not None else Path(file).read_bytes()
+    state = {'mtime':stat.st_mtime_ns, 'size':stat.st_size, 'hash':hashlib.md5(content).hexdigest()}
+    if page:
+        state['links'] = [Path(p).name.lower() for p in page['links']]
+        state['transclusions'] = page['transclusions']
+    if previous and previous['hash'] == state['hash']:
+        state.update((key, previous[key]) for key in ('page', 'transcluded') if key in previous)
+    return state
+
+# work out which Markdown pages an incremental build has to re-render:
+# changed pages, pages linking to added or removed files, pages whose backlinks changed,
+# and (transitively) pages transcluding any of those
+def stale_pages(old_sources, sources):
+    pages = {p for p in sources if Path(p).suffix == '.md'}
+    changed = {p for p in sources if p not in old_sources or old_sources[p]['hash'] != sources[p]['hash']}
+    removed = set(old_sources) - set(sources)
+    stale = changed & pages
+    # pages the previous manifest has no All Pages entry for (written before source_state() kept it for touched pages)
+    stale |= {p for p in pages - changed if 'page' not in old_sources[p]}
+    # link resolution changes when a link target is added or removed
+    added_removed_keys = {wiki_key(p) for p in set(sources) ^ set(old_sources)}
+    stale |= {p for p in pages if added_removed_keys.intersection(sources[p]['links'] + sources[p]['transclusions'])}
+    # backlinks change on every page a changed or removed page links (or linked) to
+    backlinked_keys = set()
+    for p in changed | removed:
+        for state in (old_sources.get(p), sources.get(p)):
+            if state and 'links' in state:
+                backlinked_keys.update(state['links'])
+    stale |= {p for p in pages if wiki_key(p) in backlinked_keys}
+    # transcluded content changes whenever the transcluded page changes or is re-rendered
+    dirty_keys = {wiki_key(p) for p in changed | removed}
+    while True:
+        dirty_keys |= {wiki_key(p) for p in stale}
+        transcluding = {p for p in pages - stale if dirty_keys.intersection(sources[p]['transclusions'])}
+        if not transcluding:
+            return stale
+        stale |= transcluding
+
+# ioctl request for a copy-on-write clone of a whole file on Linux (Btrfs, XFS, bcachefs, ...)
+FICLONE = 0x40049409
+
+# clone src to dst with a copy-on-write reflink, so the two share storage until one of them is changed
+# return False if the platform or filesystem does not support it
+def reflink(src, dst):
+    if sys.platform == 'darwin':
+        import ctypes
+        try:
+            return ctypes.CDLL(None, use_errno=True).clonefile(os.fsencode(src), os.fsencode(dst), 0) == 0
+        except (AttributeError, OSError):
+            return False
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(src, 'rb') as infile, open(dst, 'wb') as outfile:
+        try:
+            fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+            return True
+        except OSError:
+            return False
+
+# build times as rendered into pages (build_time in build()), e.g. "Monday, January 01, 2024 at 12:00 UTC"
+BUILD_TIME_PATTERN = re.compile(r'[A-Z][a-z]+day, [A-Z][a-z]+ \d\d, \d{4} at \d\d:\d\d UTC')
+
+# whether the old text is the same as the new text, except that where the new text has build_time,
+# the old text may have any build time (that of the build that wrote it); build times elsewhere,
+# e.g. in page content, must be the same
+def same_but_build_time(new, old, build_time):
+    position = 0
+    for i, part in enumerate(new.split(build_time)):
+        if i:
+            match = BUILD_TIME_PATTERN.match(old, position)
+            if not match:
+                return False
+            position = match.end()
+        if not old.startswith(part, position):
+            return False
+        position += len(part)
+    return position == len(old)
+
+# write text to an output file, unless the file already has the same content
+# with build_time, content that only differs in the build time rendered into it counts as the same (see
+# same_but_build_time()), so the file keeps the build time of the build that last changed it
+# the file is replaced rather than written in place, as it may be hard linked to a wiki file (see copy_file())
+# return True if the file was written
+def write_output(path, text, build_time=None):
+    data = text.encode('utf-8')
+    try:
+        with open(path, 'rb') as infile:
+            existing = infile.read()
+    except OSError:
+        existing = None
+    if existing == data:
+        return False
+    if existing is not None and build_time:
+        if same_but_build_time(text, existing.decode('utf-8', 'replace'), build_time):
+            return False
+    with open(f"{path}.tmp", 'wb') as outfile:
+        outfile.write(data)
+    os.replace(f"{path}.tmp", path)
+    return True
+
+# write_output() for large generated files, without holding all their text in memory:
+# write_content(outfile) writes the content to a temporary file, which is compared with the existing file
+# line by line (the build time never spans lines)
+def write_output_streamed(path, write_content, build_time=None):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as outfile:
+        write_content(outfile)
+    same_line = (lambda a, b: same_but_build_time(a, b, build_time)) if build_time else (lambda a, b: a == b)
+    try:
+        with open(tmp_path, encoding='utf-8', newline='') as new, open(path, encoding='utf-8', errors='replace', newline='') as old:
+            same = all(a is not None and b is not None and same_line(a, b)
+                       for a, b in itertools.zip_longest(new, old))
+    except OSError:
+        same = False
+    if same:
+        os.unlink(tmp_path)
+        return False
+    os.replace(tmp_path, path)
+    return True
+
+# copy a file to the output directory, according to --copy-mode:
+# 'copy' copies it, 'hardlink' hard links it (copying across filesystems), 'reflink' clones it where the filesystem
+# supports copy-on-write (copying otherwise), and 'skip-unchanged' copies it with its mtime, unless an existing
+# output file already has the same size and mtime
+# return True if the file was copied, False if the existing output file was kept
+def copy_file(src, dst, mode='copy'):
+    if os.path.lexists(dst):
+        if mode == 'skip-unchanged':
+            src_stat, dst_stat = os.stat(src), os.stat(dst)
+            if src_stat.st_size == dst_stat.st_size and src_stat.st_mtime_ns == dst_stat.st_mtime_ns:
+                return False
+        if mode == 'hardlink' and os.path.samefile(src, dst):
+            return False
+        # never write through an existing output, which may be hard linked to a wiki file
+        os.unlink(dst)
+    if mode == 'hardlink':
+        try:
+            os.link(src, dst)
+            return True
+        except OSError:
+            logging.debug("can't hard link %s, copying", src)
+    elif mode == 'reflink' and reflink(src, dst):
+        shutil.copymode(src, dst)
+        return True
+    if mode == 'skip-unchanged':
+        shutil.copy2(src, dst)
+    else:
+        shutil.copy(src, dst)
+    return True
+
+# remove files and directories left in a reused output directory by earlier builds:
+# anything not in outputs (site paths of the build's output files) and not written since this build started
+# return the site paths of the removed files
+def remove_stale_outputs(dir_output, outputs, build_started_ns):
+    output_dirs = {Path(output).parent.as_posix() for output in outputs}
+    removed = []
+    for dirpath, dirnames, filenames in os.walk(dir_output, topdown=False):
+        site_dir = '/' + Path(dirpath).relative_to(dir_output).as_posix() if dirpath != dir_output else '/'
+        for filename in filenames:
+            site_path = site_dir.rstrip('/') + '/' + filename
+            if site_path not in outputs and os.lstat(Path(dirpath) / filename).st_mtime_ns < build_started_ns:
+                logging.debug("remove %s", site_path)
+                os.unlink(Path(dirpath) / filename)
+                removed.append(site_path)
+        if site_dir != '/' and site_dir not in output_dirs and not os.listdir(dirpath):
+            logging.debug("remove %s", site_dir)
+            os.rmdir(dirpath)
+    return removed
+
+class SpilledList:
+    """
+    Append-only list of JSON-serializable dicts, kept in a temporary file instead of in memory (for --low-memory).
+
+    Only each item's file offset and its sort_fields stay in memory. sorted() returns a SpilledView, which reads
+    the items back from the file in sorted order, one at a time.
+    """
+    def __init__(self, sort_fields):
+        self._file = tempfile.TemporaryFile()
+        self._sort_fields = sort_fields
+        self._index = [] # ({sort field: value}, offset) for every item, in append order
+
+    def append(self, item):
+        offset = self._file.seek(0, os.SEEK_END)
+        self._file.write(json.dumps(item, default=datetime_date_serializer).encode('utf-8') + b'\n')
+        self._index.append(({field: item[field] for field in self._sort_fields}, offset))
+
+    def _read(self, offset):
+        self._file.seek(offset)
+        return json.loads(self._file.readline())
+
+    # key is called with a dict of the item's sort fields, so the same key works as with sorted() on a list
+    def sorted(self, key, reverse=False):
+        return SpilledView(self, [offset for _, offset in sorted(self._index, key=lambda entry: key(entry[0]), reverse=reverse)])
+
+    # the n largest items by key, largest first, as a list (the same as self.sorted(key, reverse=True)[:n])
+    def largest(self, n, key):
+        return [self._read(offset) for _, offset in heapq.nlargest(n, self._index, key=lambda entry: key(entry[0]))]
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        return (self._read(offset) for _, offset in self._index)
+
+class SpilledView:
+    """
+    A SpilledList in some order: can be iterated (more than once), measured with len(), and sliced into a list.
+    """
+    def __init__(self, spilled, offsets):
+        self._spilled = spilled
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __iter__(self):
+        return (self._spilled._read(offset) for offset in self._offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._spilled._read(offset) for offset in self._offsets[index]]
+        return self._spilled._read(self._offsets[index])
+
+class SortedOnUse:
+    """
+    A sequence of length items, sorted by calling sort() only when it is first iterated or indexed, so a
+    template that doesn't use it (like pages_chrono in most themes) doesn't cost a sort.
+    """
+    def __init__(self, sort, length):
+        self._sort = sort
+        self._length = length
+        self._items = None
+
+    def _sorted(self):
+        if self._items is None:
+            self._items = self._sort()
+        return self._items
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return iter(self._sorted())
+
+    def __getitem__(self, index):
+        return self._sorted()[index]
+
+# site path of page number (counting from 1) of a paginated all-pages.html
+def all_pages_path(number):
+    return '/all-pages.html' if number == 1 else f'/all-pages-{number}.html'
+
+# Git information for pages without --commits, or without any commits
+NO_GIT_INFO = {'date':'', 'change':'', 'author':''}
+
+# get the most recent commit time, author, and message for every file in the wiki, with one `git log` walk
+# the result is cached in cache_dir against the HEAD commit, so rebuilding the same commit skips the walk
+# return a dict of wiki-relative path -> {'date', 'change', 'author'}
+def git_history(dir_wiki, cache_dir):
+    p = subprocess.run(["git", "-C", dir_wiki, "rev-parse", "HEAD"], capture_output=True, check=True)
+    head = p.stdout.decode('utf-8').strip()
+    cache_path = Path(cache_dir) / 'git-history.json'
+    try:
+        with open(cache_path, encoding='utf-8') as infile:
+            cache = json.load(infile)
+        if cache['head'] == head and cache['wiki'] == dir_wiki:
+            logging.debug("using cached Git history for %s", head)
+            return cache['history']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    # commits come newest first; each is '\x1e' + header, then (after a newline) NUL-separated file names
+    logging.debug("reading Git history for %s", head)
+    from dateutil.parser import parse # pip install python-dateutil
+    p = subprocess.run(["git", "-C", dir_wiki, "log", "-z", "--name-only", "--relative", "--pretty=format:%x1e%cI%x09%an%x09%s"], capture_output=True, check=True)
+    history = {}
+    for commit in p.stdout.decode('utf-8').split('\x1e')[1:]:
+        header, _, files = commit.partition('\n')
+        new_files = [f for f in files.split('\0') if f and f not in history]
+        if new_files:
+            (date,author,change) = header.rstrip('\0').split('\t',2)
+            date = parse(date).astimezone(datetime.timezone.utc).strftime("%Y-%m-%d, %H:%M")
+            for f in new_files:
+                history[f] = {'date':date, 'change':change, 'author':author}
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_path.with_suffix('.tmp'), 'w', encoding='utf-8') as outfile:
+        json.dump({'head':head, 'wiki':dir_wiki, 'history':history}, outfile)
+    os.replace(cache_path.with_suffix('.tmp'), cache_path)
+    return history
+
+# wall-clock seconds spent in each stage of the build (reported by --profile), in the order the stages first ended
+stage_times = {}
+stage_clock = {'start':time.perf_counter(), 'nested':0.0}
+
+# end the current stage of the build: add the time since the previous stage ended to its total,
+# less any time spent in timed() calls during it
+def end_stage(name):
+    now = time.perf_counter()
+    stage_times[name] = stage_times.get(name, 0.0) + now - stage_clock['start'] - stage_clock['nested']
+    stage_clock.update(start=now, nested=0.0)
+
+# call function, adding the time it takes to stage name instead of to the current stage
+def timed(name, function, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_times[name] = stage_times.get(name, 0.0) + elapsed
+        stage_clock['nested'] += elapsed
+
+# write the --profile report: time per stage, per-page totals, and the slowest pages
+def write_profile(path, total_time, jobs, page_profiles):
+    pages = sorted(page_profiles.items(), key=lambda item: item[1]['parse'] + item[1]['render'] + item[1]['template'], reverse=True)
+    totals = {key: sum(profile[key] for profile in page_profiles.values()) for key in ('parse', 'render', 'template', 'bytes_in', 'bytes_out', 'links_resolved', 'links_incipient')}
+    with open(path, 'w') as outfile:
+        json.dump({
+            'builder_version':APPVERSION,
+            'jobs':jobs,
+            'total_time':round(total_time, 6),
+            'stages':{name: round(seconds, 6) for name, seconds in stage_times.items()},
+            'pages':dict(count=len(page_profiles), **{key: round(value, 6) for key, value in totals.items()}),
+            'slowest_pages':[dict(path=fs_path, **{key: round(value, 6) for key, value in profile.items()}) for fs_path, profile in pages[:PROFILE_SLOWEST_PAGES]],
+        }, outfile, indent=2)
+    for name, seconds in stage_times.items():
+        logging.info("profile: %-14s %8.3fs", name, seconds)
+
+# length of the page abstracts in All Pages and Recent Pages
+ABSTRACT_WIDTH = 257
+
+# take the Markdown of a page, and return its abstract: the text without Markdown headers, whitespace collapsed,
+# shortened to ABSTRACT_WIDTH characters at a word boundary (the same as textwrap.shorten() of all the text)
+# only reads as many lines as the abstract can need
+def page_abstract(markdown_text):
+    lines = []
+    length = 0 # of the text so far with whitespace collapsed, plus one
+    start = 0
+    while start < len(markdown_text) and length <= ABSTRACT_WIDTH + 1:
+        end = markdown_text.find('\n', start) + 1 or len(markdown_text)
+        if markdown_text[start] != '#':
+            line = markdown_text[start:end]
+            lines.append(line)
+            length += sum(len(word) + 1 for word in line.split())
+        start = end
+    return textwrap.shorten(''.join(lines), width=ABSTRACT_WIDTH)
+
+# everything a page-rendering worker needs besides wiki_pagelinks, set up once per process by init_render_worker()
+render_context = {}
+
+# set up a page-rendering process (or the main process, for serial builds):
+# take read-only copies of the finished wiki_pagelinks and wiki_pages, and compile the page template
+def init_render_worker(context, pagelinks, pages):
+    if pagelinks is not wiki_pagelinks:
+        wiki_pagelinks.clear()
+        wiki_pagelinks.update(pagelinks)
+    if pages is not wiki_pages:
+        wiki_pages.clear()
+        wiki_pages.update(pages)
+    render_context.clear()
+    render_context.update(context)
+    env = jinja2_environment(context['dir_templates'], context['dir_template_cache'])
+    env.globals.update(context['layout'])
+    render_context['page'] = env.get_template('page.html')
+    render_context['text_digests'] = {} # of transcluded pages, see render_dependency()
+    if transclusion_cache is not None:
+        transclusion_cache.maxsize = transclusion_cache_size()
+
+# maximum number of entries in the transclusion cache of a page-rendering process
+def transclusion_cache_size():
+    return LOW_MEMORY_TRANSCLUSION_CACHE_SIZE if render_context.get('low_memory') else None
+
+# render one Markdown file to HTML and JSON in the output directory
+# return its All Pages entry (without Git information), the pages transcluded into it,
+# the site paths of the output files it changed (see write_output()), (if tracing) its link resolution decisions, (if profiling) its timings and sizes,
+# and (with a render cache) whether its HTML came from the cache
+def render_page(file):
+    c = render_context
+    fs_path = c['rootdir']+Path(file).relative_to(c['dir_wiki']).as_posix()
+    clean_filepath = scrub_path(fs_path)
+    logging.info("Rendering %s", file)
+    # take Markdown and front matter from the ingested page
+    page = wiki_pages[fs_path]
+    text = ingested_text(page)
+    markdown_text = text[page['markdown_start']:]
+    front_matter = page['front_matter']
+    if front_matter is False:
+        print(f"NOTE: YAML syntax error in front matter of '{Path(file)}'")
+        front_matter = {}
+    # output JSON of front matter
+    front_matter_json = json.dumps(front_matter, indent=2, default=datetime_date_serializer)
+    json_path = Path(clean_filepath).with_suffix(".json").as_posix()
+    written = [json_path] if write_output(c['dir_output']+json_path, front_matter_json) else []
+    # render and output HTML
+    file_id = hashlib.md5(page['key'].encode()).hexdigest()
+    trace = [] if c['trace'] else None
+    profile = {} if c['profile'] else None
+    cached = None
+    if c['render_cache']:
+        cache_start = time.perf_counter()
+        cache_path = render_cache_path(c['render_cache'], markdown_text, file_id)
+        # (a traced page is rendered afresh, for its decisions)
+        cached = render_cache_get(cache_path) if trace is None else None
+    if cached:
+        markdown_body, transclusions = cached['html'], cached['transclusions']
+        if profile is not None:
+            profile.update(parse=0.0, render=time.perf_counter() - cache_start, links_resolved=cached['resolved'], links_incipient=cached['incipient'])
+    elif c['render_cache']:
+        timings = profile if profile is not None else {}
+        lookups = {}
+        markdown_body, transclusions = markdown_convert(markdown_text, c['fileroot'], file_id, trace, timings, lookups)
+        render_cache_put(cache_path, {
+            'lookups':{key: render_dependency(key, transcluded) for key, transcluded in lookups.items()},
+            'html':markdown_body,
+            'transclusions':transclusions,
+            'resolved':timings['links_resolved'],
+            'incipient':timings['links_incipient'],
+        })
+    else:
+        markdown_body, transclusions = markdown_convert(markdown_text, c['fileroot'], file_id, trace, profile)
+    template_start = time.perf_counter()
+    html = c['page'].render(
+        title=Path(file).stem,
+        markdown_body=markdown_body,
+        backlinks=wiki_pagelinks.get(page['key'])['backlinks'],
+    )
+    if profile is not None:
+        profile['template'] = time.perf_counter() - template_start
+        profile['bytes_in'] = len(text.encode())
+        profile['bytes_out'] = len(html.encode()) + len(front_matter_json.encode())
+    html_path = Path(clean_filepath).with_suffix(".html").as_posix()
+    if write_output(c['dir_output']+html_path, html, build_time=c['layout']['build_time']):
+        written.append(html_path)
+
+    # remember this page for All Pages
+    # strip Markdown headers and add truncated content (used for recent_pages)
+    return {
+        'page':{
+            'title':Path(file).stem,
+            'path':html_path,
+            'abstract':page_abstract(markdown_text),
+        },
+        'written':written,
+        'transclusions':transclusions,
+        'trace':trace,
+        'profile':profile,
+        'cached':bool(cached),
+    }
+
+# render Markdown files, serially or across a pool of worker processes
+# yield their render_page() results in the same order as files, as they are rendered
+def render_pages(files, context, jobs):
+    init_render_worker(context, wiki_pagelinks, wiki_pages)
+    # a handful of pages (e.g. a --watch rebuild) renders faster than worker processes start
+    if jobs == 1 or len(files) < 2 * jobs:
+        yield from map(render_page, files)
+        return
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_render_worker, initargs=(context, wiki_pagelinks, wiki_pages)) as executor:
+        yield from executor.map(render_page, files, chunksize=max(1, len(files) // (jobs * 4)))
+
+# the render cache (--render-cache): HTML rendered by markdown_convert(), in a directory that builds of different
+# branches of a wiki, even at the same time, can share
+# each file in it holds up to RENDER_CACHE_RESULTS renderings of the same Markdown, newest first, with what each
+# depended on (see render_dependency()); it is named by the hash of the Markdown, the page's wikipage_id, and the renderer
+# files are replaced atomically, so builds never read half-written ones, and touched when used, so the least recently
+# used are evicted first
+RENDER_CACHE_VERSION = 1
+RENDER_CACHE_RESULTS = 4
+# when the render cache grows past its size, it is cut to this fraction of it, so it is not evicted from every build
+RENDER_CACHE_EVICT_TO = 0.9
+
+# hash of the builder and renderer versions, and the renderer's code, so a cache never serves another renderer's HTML
+@functools.lru_cache(maxsize=None)
+def render_cache_salt():
+    import mistletoe
+    import mistletoe_renderer.massivewiki
+    salt = hashlib.md5(f"{RENDER_CACHE_VERSION}\0{APPVERSION}\0{mistletoe.__version__}\0".encode())
+    salt.update(Path(mistletoe_renderer.massivewiki.__file__).read_bytes())
+    return salt.hexdigest()
+
+# path of the render cache file for a page's Markdown
+def render_cache_path(cache_dir, markdown_text, file_id):
+    digest = hashlib.md5(f"{render_cache_salt()}\0{file_id}\0{markdown_text}".encode()).hexdigest()
+    return os.path.join(cache_dir, digest[:2], digest[2:] + '.json')
+
+# what a rendering depends on for a wikilink key it looked up: None if the key doesn't resolve, otherwise the fs_path
+# of the file it resolves to (its link's href, html_path, and wikipage_id are made from that), and for transcluded
+# pages, the hash of their text
+def render_dependency(key, transcluded):
+    entry = wiki_pagelinks.get(key)
+    if entry is None:
+        return None
+    fs_path = entry['fs_path']
+    if not transcluded:
+        return fs_path
+    digests = render_context['text_digests']
+    if fs_path not in digests:
+        digests[fs_path] = hashlib.md5(page_text(fs_path).encode()).hexdigest()
+    return [fs_path, digests[fs_path]]
+
+# read the renderings in a render cache file
+def read_render_cache_file(path):
+    try:
+        with open(path, encoding='utf-8') as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        # not cached yet, or evicted or replaced by another build meanwhile
+        return []
+
+# return the cached rendering at path that depended on what the wiki has now, or None
+def render_cache_get(path):
+    for result in read_render_cache_file(path):
+        if all(render_dependency(key, isinstance(value, list)) == value for key, value in result['lookups'].items()):
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return result
+    return None
+
+# add a rendering to the render cache file at path
+def render_cache_put(path, result):
+    results = [result] + [old for old in read_render_cache_file(path) if old['lookups'] != result['lookups']][:RENDER_CACHE_RESULTS - 1]
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w', encoding='utf-8') as outfile:
+            json.dump(results, outfile)
+        os.replace(temp_path, path)
+    except OSError as e:
+        logging.warning("can't write to the render cache: %s", e)
+
+# evict the least recently used files of the render cache in cache_dir, if it is larger than max_size bytes
+# return the number of files evicted, and the size of the cache
+def render_cache_evict(cache_dir, max_size):
+    files = []
+    if not os.path.isdir(cache_dir):
+        return 0, 0
+    for shard in os.scandir(cache_dir):
+        if shard.is_dir():
+            for entry in os.scandir(shard.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    size = sum(file_size for _, file_size, _ in files)
+    evicted = 0
+    if size > max_size:
+        files.sort()
+        for _, file_size, path in files:
+            if size <= max_size * RENDER_CACHE_EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= file_size
+            evicted += 1
+    return evicted, size
+
+# compress data in format ('gzip' or 'br'), at the highest level: compressed copies are only made again when a file changes,
+# and are served many times
+def compress_bytes(data, format):
+    if format == 'gzip':
+        import gzip
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    import brotli # pip install brotli
+    return brotli.compress(data, quality=11)
+
+# suffix of the compressed copies of files in format
+COMPRESSED_SUFFIXES = {'gzip':'.gz', 'br':'.br'}
+
+# the record of what the compressed copies in an output directory were made from, in the cache directory
+COMPRESSION_RECORD = 'compressed.json'
+
+# bring the compressed copies of the file at path, in each of formats, up to date (e.g. path.gz)
+# digest is the md5 of the content the existing copies were made from: if the file's content is the same
+# (e.g. it was copied again), they are kept, and only touched so they are newer than the file
+# return the md5 of the file's content, and the formats that were compressed
+def compress_output(path, formats, digest):
+    with open(path, 'rb') as infile:
+        data = infile.read()
+    new_digest = hashlib.md5(data).hexdigest()
+    compressed = []
+    for format in formats:
+        compressed_path = path + COMPRESSED_SUFFIXES[format]
+        if new_digest == digest and os.path.exists(compressed_path):
+            os.utime(compressed_path)
+            continue
+        with open(compressed_path + '.tmp', 'wb') as outfile:
+            outfile.write(compress_bytes(data, format))
+        os.replace(compressed_path + '.tmp', compressed_path)
+        compressed.append(format)
+    return new_digest, compressed
 
 # handle datetime.date serialization for json.dumps()
 def datetime_date_serializer(o):
@@ -126,53 +1049,133 @@ def main():
     argparser = init_argparse()
     args = argparser.parse_args()
     logging.debug("args: %s", args)
+    if args.compress and 'br' in args.compress:
+        try:
+            import brotli
+        except ImportError:
+            argparser.error("--compress br needs the brotli package: pip install brotli")
+
+    if args.watch:
+        return watch(args)
+    build(args)
+
+# build the website, then rebuild it whenever the wiki, templates, or config change, serving it with live reload
+# rebuilds are incremental, keep ingested pages in memory, and only re-render the pages a change affects
+def watch(args):
+    from watch import make_watcher, PreviewServer
+    args.incremental = True
+    dir_output = Path(args.output).resolve()
+    dir_cache = Path(args.cache_dir).resolve() if args.cache_dir else dir_output.parent / '.mwb-cache'
+    # watch before the first build, so changes made during it are seen
+    dir_templates = os.path.abspath(args.templates)
+    watcher = make_watcher([args.wiki, args.templates], files=[args.config], ignore=[dir_output, dir_cache])
+    state = {}
+    build(args, state)
+    server = PreviewServer(dir_output, args.port)
+    print(f"Serving {dir_output} at http://localhost:{args.port}/ - watching for changes, press Ctrl-C to stop")
+    try:
+        while True:
+            changed = watcher.changes()
+            logging.info("changed: %s", sorted(changed))
+            if any(path == dir_templates or path.startswith(dir_templates + os.sep) for path in changed):
+                jinja2_environment.cache_clear() # load the changed templates
+            start = time.perf_counter()
+            try:
+                build(args, state)
+            except Exception:
+                traceback.print_exc()
+                continue
+            print(f"Rebuilt in {time.perf_counter() - start:.3f}s ({len(changed)} changed)")
+            server.reload()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        watcher.close()
+        # leave the manifest for the next incremental build
+        if 'manifest' in state:
+            save_manifest(dir_output / MANIFEST_FILENAME, state['manifest'])
+
+# build the website
+# for --watch, state carries what a rebuild can reuse from the previous build in this process
+def build(args, state=None):
+    build_start = time.perf_counter()
+    stage_clock.update(start=build_start, nested=0.0)
+    stage_times.clear()
+    wiki_pagelinks.clear()
+    wiki_pages.clear()
+    if transclusion_cache is not None:
+        transclusion_cache.clear()
 
     # get configuration
     config = load_config(args.config)
     if not 'recent_changes_count' in config:
         config['recent_changes_count'] = 5
+    if not config.get('all_pages_per_page'):
+        config['all_pages_per_page'] = 0
 
     # remember paths
     dir_output = Path(args.output).resolve().as_posix()
     dir_templates = Path(args.templates).resolve().as_posix()
     dir_wiki = Path(args.wiki).resolve().as_posix()
+    dir_cache = Path(args.cache_dir).resolve().as_posix() if args.cache_dir else (Path(dir_output).parent / '.mwb-cache').as_posix()
+    # compiled templates are only cached on disk in a cache directory given with --cache-dir, so builds don't
+    # leave one next to the output directory (in a wiki checkout, say) unless a cache is needed for something else
+    dir_template_cache = dir_cache + '/templates' if args.cache_dir else None
     rootdir = '/'
 
     # get a Jinja2 environment
-    j = jinja2_environment(dir_templates)
+    if args.compile_theme:
+        compile_theme(dir_templates)
+        jinja2_environment.cache_clear()
+    j = jinja2_environment(dir_templates, dir_template_cache)
 
-    # set up lunr_index_filename and lunr_index_sitepath
+    # set up the lunr index (file names are set once all pages are read)
     if (args.lunr):
-        timestamp_thisrun = time.time()
-        lunr_index_filename = f"lunr-index-{timestamp_thisrun}.js" # needed for next two variables
-        lunr_index_filepath = Path(dir_output) / lunr_index_filename # local filesystem
-        lunr_index_sitepath = '/'+lunr_index_filename # website
-        lunr_posts_filename = f"lunr-posts-{timestamp_thisrun}.js" # needed for next two variables
-        lunr_posts_filepath = Path(dir_output) / lunr_posts_filename # local filesystem
-        lunr_posts_sitepath = '/'+lunr_posts_filename # website
+        from lunr_index import LunrIndexBuilder, tokenize # Lunr search index
+        lunr_builder = LunrIndexBuilder(spill=args.low_memory) # pages are added to the index as they are read
+        lunr_digest = hashlib.md5(str(args.lunr_shards).encode()) # of everything added to the index and posts list
+
+    # incremental builds compare against the manifest left by the previous incremental build
+    manifest_path = Path(dir_output) / MANIFEST_FILENAME
+    # (under --watch, the previous build's manifest is kept in memory)
+    if state is not None and 'manifest' in state:
+        old_manifest = state['manifest']
     else:
-        # needed to feed to themes
-        lunr_index_sitepath = ''
-        lunr_posts_sitepath = ''
+        old_manifest = load_manifest(manifest_path) if args.incremental else None
 
     # render the wiki
     try:
-        # remove existing output directory and recreate
-        logging.debug("remove existing output directory and recreate")
-        shutil.rmtree(dir_output, ignore_errors=True)
-        os.mkdir(dir_output)
+        # reuse an existing output directory, so files that don't change keep their mtimes
+        reuse_output = os.path.isdir(dir_output)
+        if not reuse_output:
+            logging.debug("create output directory")
+            os.mkdir(dir_output)
+        else:
+            logging.debug("keeping existing output directory")
+            # anything in it written before now, and not copied by this build, is stale; take the time from the
+            # filesystem itself, so its timestamp granularity doesn't matter
+            marker = Path(dir_output) / '.mwb-build-started'
+            marker.touch()
+            build_started_ns = marker.stat().st_mtime_ns
+            marker.unlink()
+        copy_output = functools.partial(copy_file, mode=args.copy_mode)
+        end_stage('setup')
         
-        # get list of wiki files using a glob.iglob iterator (consumed in list comprehension)
-        # 'include_hidden=False' requires Python 3.11 - TODO: use `include_hidden=False` when we have 3.11 support
-        #allfiles = [f for f in glob.iglob(f"{dir_wiki}/**/*.*", recursive=True, include_hidden=False)]        
-        allfiles = [f for f in glob.iglob(f"{dir_wiki}/**/*", recursive=True) if os.path.isfile(f)]
+        # get list of wiki files
+        allfiles = discover_files(dir_wiki, config.get('ignore') or [])
+        # the fs_path of every file (its path from the wiki root), worked out once
+        fs_paths = {file: rootdir+Path(file).relative_to(dir_wiki).as_posix() for file in allfiles}
+        end_stage('discovery')
     
-        # read wiki content and build wikilinks dictionary; lunr index lists
-        lunr_idx_data=[]
-        lunr_posts=[]
+        # read wiki content (each Markdown file exactly once) and build wikilinks dictionary; lunr index and posts list
+        # under --watch, pages whose mtime and size haven't changed are taken from the previous build,
+        # along with their lunr terms
+        ingested = state.setdefault('ingested', {}) if state is not None else None
+        lunr_posts = SpilledList([]) if args.low_memory else []
         for file in allfiles:
             logging.debug("file %s: ", file)
-            fs_path = rootdir+Path(file).relative_to(dir_wiki).as_posix()
+            fs_path = fs_paths[file]
             clean_filepath = scrub_path(fs_path)
             if Path(file).suffix == '.md':
                 logging.debug("key: %s", Path(file).name)
@@ -180,188 +1183,460 @@ def main():
                 logging.debug("html path: %s", html_path)
                 # add filesystem path, html path, backlinks list, wikipage-id to wiki_path_links dictionary
                 wikipage_id = hashlib.md5(Path(file).stem.lower().encode()).hexdigest()
-                wiki_pagelinks[Path(file).stem.lower()] = {'fs_path':fs_path, 'html_path':html_path, 'backlinks':[], 'wikipage_id':wikipage_id}
-                # add lunr data to lunr idx_data and posts lists
+                wiki_pagelinks[Path(file).stem.lower()] = {'fs_path':fs_path, 'html_path':html_path, 'href':wikilink_href(rootdir, html_path), 'backlinks':[], 'wikipage_id':wikipage_id}
+                if ingested is not None:
+                    stat = os.stat(file)
+                    stat = (stat.st_mtime_ns, stat.st_size)
+                    if fs_path not in ingested or ingested[fs_path]['stat'] != stat:
+                        ingested[fs_path] = {'stat':stat, 'page':ingest_page(file), 'lunr_terms':None}
+                    wiki_pages[fs_path] = ingested[fs_path]['page']
+                else:
+                    wiki_pages[fs_path] = ingest_page(file)
+                # add page to lunr index and posts list
                 if(args.lunr):
                     link = Path(clean_filepath).with_suffix(".html").as_posix()
                     title = Path(file).stem
-                    lunr_idx_data.append({"link":link, "title":title, "body": Path(file).read_text(encoding='utf-8')})
+                    if ingested is not None:
+                        if ingested[fs_path]['lunr_terms'] is None:
+                            ingested[fs_path]['lunr_terms'] = timed('lunr', lambda: {'title':tokenize(title), 'body':tokenize(wiki_pages[fs_path]['text'])})
+                        timed('lunr', lunr_builder.add_terms, link, **ingested[fs_path]['lunr_terms'])
+                    else:
+                        timed('lunr', lunr_builder.add, link, title=title, body=wiki_pages[fs_path]['text'])
                     lunr_posts.append({"link":link, "title":title})
+                    lunr_digest.update(f"{link}\0{title}\0{wiki_pages[fs_path]['text']}\0".encode())
+                # with --low-memory, only keep what the link index needs; the text is read again when rendering
+                if args.low_memory:
+                    wiki_pages[fs_path] = dict(wiki_pages[fs_path], text=None, file=file)
             else:
                 logging.debug("key: %s", Path(file).name)
                 html_path = clean_filepath
                 logging.debug("html path: %s", html_path)
                 # add html path and backlinks list to wiki_pagelinks dict
-                wiki_pagelinks[Path(file).name.lower()] = {'fs_path':fs_path, 'html_path':html_path, 'backlinks':[]}
+                wiki_pagelinks[Path(file).name.lower()] = {'fs_path':fs_path, 'html_path':html_path, 'href':wikilink_href(rootdir, html_path), 'backlinks':[]}
                 
+        if ingested is not None:
+            for fs_path in set(ingested) - set(wiki_pages):
+                del ingested[fs_path]
+        # set up lunr_index_filename and lunr_index_sitepath
+        # the files are named after their content, so every page (which links to them) only changes when the index does
+        if (args.lunr):
+            lunr_version = lunr_digest.hexdigest()[:16]
+            if state is not None:
+                # rebuilds under --watch keep the file names, so pages don't all need re-rendering
+                lunr_version = state.setdefault('lunr_version', lunr_version)
+            lunr_index_filename = f"lunr-index-{lunr_version}.js" # needed for next two variables
+            lunr_index_filepath = Path(dir_output) / lunr_index_filename # local filesystem
+            lunr_index_sitepath = '/'+lunr_index_filename # website
+            lunr_posts_filename = f"lunr-posts-{lunr_version}.js" # needed for next two variables
+            lunr_posts_filepath = Path(dir_output) / lunr_posts_filename # local filesystem
+            lunr_posts_sitepath = '/'+lunr_posts_filename # website
+        else:
+            # needed to feed to themes
+            lunr_index_sitepath = ''
+            lunr_posts_sitepath = ''
         logging.debug("wiki page links: %s", wiki_pagelinks)
-        logging.debug("lunr index length %s: ",len(lunr_idx_data))
+        logging.debug("lunr index length %s: ",len(lunr_posts))
+        end_stage('ingest')
 
-        # update wiki_pagelinks dictionary with backlinks
-        for file in allfiles:
-            if Path(file).name == config['sidebar']:  # do not backlink to sidebar
-                continue
-            if Path(file).suffix == '.md':
-                to_links = find_tolinks(file)
-                for page in to_links:
-                    logging.info("on page %s add backlink to page %s", Path(page).stem, wiki_pagelinks[Path(file).stem.lower()]['html_path'])
-                    if ( Path(page).name.lower() in wiki_pagelinks and
-                         not any(wiki_pagelinks[Path(file).stem.lower()]['html_path'] in t for t in wiki_pagelinks[Path(page).name.lower()]['backlinks']) ):
-                        backlink_tuple = (wiki_pagelinks[Path(file).stem.lower()]['html_path'],Path(file).stem)
-                        wiki_pagelinks[Path(page).name.lower()]['backlinks'].append(backlink_tuple)
+        # record the state of every source file for the manifest
+        if args.incremental:
+            old_sources = old_manifest['sources'] if old_manifest else {}
+            sources = {}
+            for file in allfiles:
+                fs_path = fs_paths[file]
+                sources[fs_path] = source_state(file, old_sources.get(fs_path), wiki_pages.get(fs_path))
+            end_stage('incremental')
+
+        # build the link graph and update wiki_pagelinks dictionary with backlinks
+        link_graph = LinkGraph(wiki_pagelinks)
+        for fs_path, wiki_page in wiki_pages.items():
+            if Path(fs_path).name == config['sidebar']:  # do not backlink to sidebar
+                link_graph.add_page(wiki_page['key'], Path(fs_path).stem, [])
+            else:
+                link_graph.add_page(wiki_page['key'], Path(fs_path).stem, wiki_page['links'])
+        for key in wiki_pagelinks:
+            wiki_pagelinks[key]['backlinks'] = link_graph.backlinks(key)
+        end_stage('backlinks')
 
         # render all the Markdown files
         logging.debug("copy wiki to output; render .md files to HTML")
-        all_pages = []
-        page = j.get_template('page.html')
+        all_pages = SpilledList(['title', 'date']) if args.low_memory else []
         build_time = datetime.datetime.now(datetime.timezone.utc).strftime("%A, %B %d, %Y at %H:%M UTC")
 
         if 'sidebar' in config:
-            sidebar_body = sidebar_convert_markdown(Path(dir_wiki) / config['sidebar'], args.wiki)
+            sidebar_path = Path(dir_wiki) / config['sidebar']
+            sidebar_page = wiki_pages.get(rootdir+config['sidebar'])
+            old_sidebar = old_manifest.get('sidebar') if args.incremental and old_manifest else None
+            # if no wiki file changed since the previous incremental build, neither did the sidebar
+            # (so a build with nothing to do doesn't need the Markdown renderer at all)
+            if (old_sidebar and old_sidebar['name'] == config['sidebar'] and (sidebar_page or not sidebar_path.exists()) and
+                    sources.keys() == old_sources.keys() and all(sources[p]['hash'] == old_sources[p]['hash'] for p in sources)):
+                sidebar_html = old_sidebar['body']
+            else:
+                sidebar_html = sidebar_convert_markdown(sidebar_path, args.wiki, sidebar_page)
+        else:
+            sidebar_html = ''
+        # with --fragments, the sidebar goes in a file of its own, named after its content, which every page loads
+        if args.fragments and sidebar_html:
+            sidebar_sitepath = f"/sidebar-{hashlib.md5(sidebar_html.encode()).hexdigest()[:16]}.html"
+            sidebar_body = fragment_loader(sidebar_sitepath)
+        else:
+            sidebar_sitepath = ''
+            sidebar_body = sidebar_html
+        end_stage('sidebar')
+
+        # pages only need re-rendering if neither the layout nor the page (or what it links to) changed;
+        # the fingerprint covers everything every page is rendered with, except the build time
+        if args.incremental:
+            fingerprint = hashlib.md5(json.dumps([
+                APPVERSION,
+                config,
+                tree_hash(dir_templates),
+                sidebar_body,
+                lunr_index_sitepath,
+                lunr_posts_sitepath,
+            ], default=datetime_date_serializer).encode()).hexdigest()
+            if old_manifest and old_manifest['fingerprint'] == fingerprint:
+                render_set = stale_pages(old_sources, sources)
+                logging.info("incremental build: re-rendering %s pages", len(render_set))
+            else:
+                logging.info("incremental build: sidebar, templates, or config changed, re-rendering all pages")
+                render_set = None
+            end_stage('incremental')
+        else:
+            render_set = None
+
+        # get commit messages and times
+        if args.commits:
+            git_pages = git_history(dir_wiki, dir_cache)
+            end_stage('git')
         else:
-            sidebar_body = ''
+            git_pages = {}
+
+        # make needed subdirectories
+        for directory in {os.path.dirname(scrub_path(fs_path)) for fs_path in fs_paths.values()}:
+            os.makedirs(dir_output+directory, exist_ok=True)
+
+        # render the Markdown files that need it, in parallel if --jobs
+        # everything the templates share is passed once, as Jinja2 globals
+        layout = {
+            'build_time':build_time,
+            'wiki_title':config['wiki_title'],
+            'author':config['author'],
+            'repo':config['repo'],
+            'license':config['license'],
+            'sidebar_body':sidebar_body,
+            'sidebar_sitepath':sidebar_sitepath,
+            'lunr_index_sitepath':lunr_index_sitepath,
+            'lunr_posts_sitepath':lunr_posts_sitepath,
+        }
+        j.globals.update(layout)
+        render_files = [file for file in allfiles if Path(file).suffix == '.md' and
+                        (render_set is None or fs_paths[file] in render_set)]
+        jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+        page_context = {
+            'rootdir':rootdir,
+            'dir_wiki':dir_wiki,
+            'dir_output':dir_output,
+            'dir_templates':dir_templates,
+            'dir_template_cache':dir_template_cache,
+            'fileroot':args.wiki,
+            'layout':layout,
+            'trace':bool(args.trace),
+            'profile':args.profile,
+            'low_memory':args.low_memory,
+            'render_cache':args.render_cache and os.path.abspath(args.render_cache),
+        }
+        # results come in the order of render_files; with --low-memory, each is handled (below) as soon as
+        # it is rendered, rather than all of them being kept until rendering is done
+        rendered_pages = render_pages(render_files, page_context, jobs)
+        if not args.low_memory:
+            rendered_pages = list(rendered_pages)
+            if transclusion_cache is not None:
+                logging.info("transclusion cache: %s hits, %s misses", transclusion_cache.hits, transclusion_cache.misses)
+            end_stage('render')
+        rendered_pages = iter(rendered_pages)
+
+        # write link resolution decisions if --trace (as pages are handled below)
+        trace_file = open(args.trace, 'w', encoding='utf-8') if args.trace else None
+        page_profiles = {}
 
+        # site paths of everything the build puts in the output directory, and of the files it added, changed, or removed
+        outputs = set()
+        changed_files = set()
+        # write a generated file to the output directory, unless it already has the same content (see write_output())
+        def write_site_file(site_path, text, ignore_build_time=False):
+            outputs.add(site_path)
+            if write_output(dir_output+site_path, text, build_time if ignore_build_time else None):
+                changed_files.add(site_path)
+        # the same for large generated files, written by write_content(outfile) (see write_output_streamed())
+        def write_site_file_streamed(site_path, write_content, ignore_build_time=False):
+            outputs.add(site_path)
+            if write_output_streamed(dir_output+site_path, write_content, build_time if ignore_build_time else None):
+                changed_files.add(site_path)
+
+        # count what the build processed, for build-results.json
+        page_count = attachment_count = bytes_processed = 0
+        render_cache_stats = {'hits':0, 'misses':0, 'evicted':0}
         for file in allfiles:
-            clean_filepath = scrub_path(rootdir+Path(file).relative_to(dir_wiki).as_posix())
-            # make needed subdirectories
-            os.makedirs(Path(dir_output+clean_filepath).parent, exist_ok=True)
-            if Path(file).suffix == '.md':
-                logging.info("Rendering %s", file)
-                # parse Markdown file
-                markdown_text, front_matter = read_markdown_and_front_matter(Path(file))
-                if front_matter is False:
-                    print(f"NOTE: YAML syntax error in front matter of '{Path(file)}'")
-                    front_matter = {}
-                # output JSON of front matter
-                (Path(dir_output+clean_filepath).with_suffix(".json")).write_text(json.dumps(front_matter, indent=2, default=datetime_date_serializer))
-                # render and output HTML
-                file_id = hashlib.md5(Path(file).stem.lower().encode()).hexdigest()
-                markdown_body = markdown_convert(markdown_text, args.wiki, file_id)
-                html = page.render(
-                    build_time=build_time,
-                    wiki_title=config['wiki_title'],
-                    author=config['author'],
-                    repo=config['repo'],
-                    license=config['license'],
-                    title=Path(file).stem,
-                    markdown_body=markdown_body,
-                    sidebar_body=sidebar_body,
-                    backlinks=wiki_pagelinks.get(Path(file).stem.lower())['backlinks'],
-                    lunr_index_sitepath=lunr_index_sitepath,
-                    lunr_posts_sitepath=lunr_posts_sitepath,
-                )
-                (Path(dir_output+clean_filepath).with_suffix(".html")).write_text(html)
-                
-                # get commit message and time
-                if args.commits:
-                    root = Path(file).parent.as_posix()
-                    p = subprocess.run(["git", "-C", Path(root), "log", "-1", '--pretty="%cI\t%an\t%s"', Path(file).name], capture_output=True, check=True)
-                    (date,author,change)=p.stdout.decode('utf-8')[1:-2].split('\t',2)
-                    date = parse(date).astimezone(datetime.timezone.utc).strftime("%Y-%m-%d, %H:%M")
-                else:
-                    date = ''
-                    change = ''
-                    author = ''
-
-                # remember this page for All Pages
-                # strip Markdown headers and add truncated content (used for recent_pages)
-                stripped_text = re.sub(r'^#+.*\n?', '', markdown_text, flags=re.MULTILINE)
-                all_pages.append({
-                    'title':Path(file).stem,
-                    'path':Path(clean_filepath).with_suffix(".html").as_posix(),
-                    'date':date,
-                    'change':change,
-                    'author':author,
-                    'abstract':textwrap.shorten(stripped_text, width=257),
-                })
-            # create build results
-            with open(Path(dir_output) / 'build-results.json', 'w') as outfile:
-                build_results = {
-                    'builder_name':APPNAME,
-                    'builder_version':APPVERSION,
-                    'build_time':build_time,
-                }
-                json.dump(build_results, outfile)
+            fs_path = fs_paths[file]
+            clean_filepath = scrub_path(fs_path)
+            is_page = file.endswith('.md')
+            if is_page:
+                page_count += 1
+                outputs.update((clean_filepath[:-3]+'.html', clean_filepath[:-3]+'.json', clean_filepath))
+            else:
+                attachment_count += 1
+                outputs.add(clean_filepath)
+            bytes_processed += os.path.getsize(file)
+            if is_page and render_set is not None and fs_path not in render_set:
+                # unchanged page in an incremental build: keep the existing output
+                logging.debug("Not re-rendering %s", file)
+                all_pages.append(dict(old_sources[fs_path]['page'], **git_pages.get(fs_path[len(rootdir):], NO_GIT_INFO)))
+                link_graph.add_transclusions(wiki_key(file), old_sources[fs_path]['transcluded'])
+            elif is_page:
+                result = next(rendered_pages)
+                if trace_file:
+                    timed('trace', trace_file.writelines, (json.dumps(dict(page=fs_path, **decision))+'\n' for decision in result['trace']))
+                if args.profile:
+                    page_profiles[fs_path] = result['profile']
+                if args.incremental:
+                    sources[fs_path]['page'] = result['page']
+                    sources[fs_path]['transcluded'] = result['transclusions']
+                all_pages.append(dict(result['page'], **git_pages.get(fs_path[len(rootdir):], NO_GIT_INFO)))
+                link_graph.add_transclusions(wiki_key(file), result['transclusions'])
+                changed_files.update(result['written'])
+                render_cache_stats['hits' if result['cached'] else 'misses'] += 1
             # copy all original files
+            if args.incremental:
+                if (fs_path in old_sources and old_sources[fs_path]['hash'] == sources[fs_path]['hash']
+                    and os.path.exists(dir_output+clean_filepath)):
+                    continue
             logging.debug("Copy all original files")
-            logging.debug("%s -->  %s",Path(file), Path(dir_output+clean_filepath))
-            shutil.copy(Path(file), Path(dir_output+clean_filepath))
+            logging.debug("%s -->  %s", file, dir_output+clean_filepath)
+            if copy_output(file, dir_output+clean_filepath):
+                changed_files.add(clean_filepath)
+        if trace_file:
+            trace_file.close()
+        if args.low_memory:
+            # pages were rendered as they were copied
+            if transclusion_cache is not None:
+                logging.info("transclusion cache: %s hits, %s misses", transclusion_cache.hits, transclusion_cache.misses)
+            end_stage('render')
+        else:
+            end_stage('copy')
+
+        # keep the render cache within its size if this build added to it
+        if args.render_cache:
+            if render_cache_stats['misses']:
+                render_cache_stats['evicted'], render_cache_stats['size'] = render_cache_evict(args.render_cache, args.render_cache_size * 1024 * 1024)
+            logging.info("render cache: %(hits)s hits, %(misses)s misses, %(evicted)s evicted", render_cache_stats)
+            end_stage('render cache')
+
+        # write the link graph (including transclusions) for dashboards and other tools
+        write_site_file('/links.json', json.dumps(link_graph.to_dict()))
+        end_stage('links')
 
         # build Lunr search index if --lunr
         if (args.lunr):
             logging.debug("building lunr index: %s", lunr_index_filepath)
-            # ref: https://lunrjs.com/guides/index_prebuilding.html
-            pages_index_bytes = json.dumps(lunr_idx_data).encode('utf-8') # NOTE: build-index.js requires text as input - convert dict to string (then do encoding to bytes either here or set `encoding` in subprocess.run())
-            with open(lunr_index_filepath, "w") as outfile:
-                print("lunr_index=", end="", file=outfile)
-                outfile.seek(0, 2) # seek to EOF
-                p = subprocess.run(['node', 'build-index.js'], input=pages_index_bytes, stdout=outfile, check=True)
-            with open(lunr_posts_filepath, "w") as outfile:
-                print("lunr_posts=", lunr_posts, file=outfile)
+            # same serialized index as lunr.js builds - ref: https://lunrjs.com/guides/index_prebuilding.html
+            if args.lunr_shards:
+                # one standalone index per shard, loaded on demand; lunr_shards maps shard keys to their site paths
+                lunr_shards = {}
+                for key, terms in lunr_builder.shards().items():
+                    shard_sitepath = f"/{Path(lunr_index_filename).stem}-{key}.json"
+                    write_site_file_streamed(shard_sitepath, lambda outfile: lunr_builder.write_shard(outfile, terms))
+                    lunr_shards[key] = shard_sitepath
+                write_site_file(lunr_index_sitepath, "lunr_shards=" + json.dumps(lunr_shards))
+            else:
+                def write_lunr_index(outfile):
+                    outfile.write("lunr_index=")
+                    lunr_builder.write(outfile)
+                write_site_file_streamed(lunr_index_sitepath, write_lunr_index)
+            # the same as print("lunr_posts=", lunr_posts), one post at a time
+            def write_lunr_posts(outfile):
+                outfile.write("lunr_posts= [")
+                for i, post in enumerate(lunr_posts):
+                    outfile.write(repr(post) if i == 0 else ", " + repr(post))
+                outfile.write("]\n")
+            write_site_file_streamed(lunr_posts_sitepath, write_lunr_posts)
+            end_stage('lunr')
 
         # temporary handling of search.html - TODO, do this better :-)
         search_page = j.get_template('search.html')
-        html = search_page.render(
-            build_time=build_time,
-            wiki_title=config['wiki_title'],
-            author=config['author'],
-            repo=config['repo'],
-            license=config['license'],
-            sidebar_body=sidebar_body,
-            lunr_index_sitepath=lunr_index_sitepath,
-            lunr_posts_sitepath=lunr_posts_sitepath,
-        )
-        (Path(dir_output) / "search.html").write_text(html)
+        html = search_page.render()
+        write_site_file('/search.html', html, ignore_build_time=True)
+        if sidebar_sitepath:
+            write_site_file(sidebar_sitepath, sidebar_html)
 
         # copy README.html to index.html if no index.html
         logging.debug("copy README.html to index.html if no index.html")
-        if not os.path.exists(Path(dir_output) / 'index.html'):
-            shutil.copyfile(Path(dir_output) / 'README.html', Path(dir_output) / 'index.html')
+        if '/index.html' not in outputs:
+            write_site_file('/index.html', (Path(dir_output) / 'README.html').read_text(encoding='utf-8'), ignore_build_time=True)
+        end_stage('special pages')
 
         # copy static assets directory
         logging.debug("copy static assets directory")
+        def copy_static(src, dst):
+            site_path = '/'+Path(dst).relative_to(dir_output).as_posix()
+            outputs.add(site_path)
+            if copy_output(src, dst):
+                changed_files.add(site_path)
         if os.path.exists(Path(dir_templates) / 'mwb-static'):
             logging.warning("mwb-static is deprecated. please use 'static', and put mwb-static inside static - see docs")
-            shutil.copytree(Path(dir_templates) / 'mwb-static', Path(dir_output) / 'mwb-static')
+            shutil.copytree(Path(dir_templates) / 'mwb-static', Path(dir_output) / 'mwb-static', copy_function=copy_static, dirs_exist_ok=True)
         if os.path.exists(Path(dir_templates) / 'static'):
-            shutil.copytree(Path(dir_templates) / 'static', Path(dir_output), dirs_exist_ok=True)
+            shutil.copytree(Path(dir_templates) / 'static', Path(dir_output), copy_function=copy_static, dirs_exist_ok=True)
+        end_stage('static')
 
-        # build all-pages.html
-        logging.debug("build all-pages.html")
+        # aggregate the pages for all-pages.html and recent-pages.html
+        logging.debug("aggregate pages")
+        # (with --low-memory, all_pages is a SpilledList, which reads the pages back in sorted order)
+        sort_pages = all_pages.sorted if args.low_memory else functools.partial(sorted, all_pages)
+        by_date = lambda i: i['date']
         if args.commits:
-            all_pages_chrono = sorted(all_pages, key=lambda i: i['date'], reverse=True)
+            # only the most recent pages are needed in date order, so take the top of a heap instead of sorting them all
+            # (nlargest keeps the order of pages with the same date, like a stable sort)
+            if args.low_memory:
+                recent_pages = all_pages.largest(config['recent_changes_count'], key=by_date)
+            else:
+                recent_pages = heapq.nlargest(config['recent_changes_count'], all_pages, key=by_date)
         else:
-            all_pages_chrono = ''
-        all_pages = sorted(all_pages, key=lambda i: i['title'].lower())
-        html = j.get_template('all-pages.html').render(
-            build_time=build_time,
-            pages=all_pages,
-            pages_chrono=all_pages_chrono,
-            wiki_title=config['wiki_title'],
-            author=config['author'],
-            repo=config['repo'],
-            license=config['license'],
-            sidebar_body=sidebar_body,
-            lunr_index_sitepath=lunr_index_sitepath,
-            lunr_posts_sitepath=lunr_posts_sitepath,
-        )
-        (Path(dir_output) / "all-pages.html").write_text(html)
+            recent_pages = ''
+        pages_by_title = sort_pages(key=lambda i: i['title'].lower())
+        # split the pages into files of all_pages_per_page pages, or all in one file
+        per_page = config['all_pages_per_page'] or max(len(pages_by_title), 1)
+        file_count = max(-(-len(pages_by_title) // per_page), 1)
+        end_stage('aggregate')
+
+        # build all-pages.html (and all-pages-2.html, ..., if paginated)
+        logging.debug(f"build all-pages.html in {file_count} file(s)")
+        page_paths = [all_pages_path(number) for number in range(1, file_count + 1)]
+        for number, path in enumerate(page_paths, start=1):
+            if file_count == 1:
+                pages = pages_by_title
+            else:
+                pages = pages_by_title[(number - 1) * per_page:number * per_page]
+            if args.commits:
+                pages_chrono = SortedOnUse(functools.partial(sorted, pages, key=by_date, reverse=True), len(pages))
+            else:
+                pages_chrono = ''
+            write_site_file_streamed(path, j.get_template('all-pages.html').stream(
+                pages=pages,
+                pages_chrono=pages_chrono,
+                pagination={
+                    'page':number,
+                    'page_count':file_count,
+                    'previous':page_paths[number - 2] if number > 1 else '',
+                    'next':page_paths[number] if number < file_count else '',
+                    'paths':page_paths,
+                },
+            ).dump, ignore_build_time=True)
 
         # build recent-pages.html
         logging.debug(f"build recent-pages.html with {config['recent_changes_count']} entries.")
-        recent_pages = all_pages_chrono[:config['recent_changes_count']]
         html = j.get_template('recent-pages.html').render(
-            build_time=build_time,
             pages=recent_pages,
-            wiki_title=config['wiki_title'],
-            author=config['author'],
-            repo=config['repo'],
-            license=config['license'],
-            sidebar_body=sidebar_body,
-            lunr_index_sitepath=lunr_index_sitepath,
-            lunr_posts_sitepath=lunr_posts_sitepath,
         )
-        (Path(dir_output) / "recent-pages.html").write_text(html)
+        write_site_file('/recent-pages.html', html, ignore_build_time=True)
+        end_stage('special pages')
+
+        # write compressed copies of the output files worth compressing, if --compress
+        # copies are up to date if their file wasn't written or copied by this build, and they are newer than it, and
+        # recorded; the others are checked against the recorded digest (mtimes alone can't tell, as --copy-mode
+        # hardlink and skip-unchanged keep the wiki file's mtime) and made again on a pool of threads
+        # (zlib and brotli compress without holding the GIL)
+        if args.compress:
+            record_path = Path(dir_cache) / COMPRESSION_RECORD
+            try:
+                with open(record_path, encoding='utf-8') as infile:
+                    record = json.load(infile)
+                digests = record['files'] if record['output'] == dir_output else {}
+            except (OSError, ValueError, KeyError):
+                digests = {}
+            compress_jobs = []
+            for site_path in sorted(outputs):
+                if Path(site_path).suffix.lower() not in COMPRESSIBLE_SUFFIXES or Path(site_path).name.startswith('.'):
+                    continue
+                stat = os.stat(dir_output+site_path)
+                if stat.st_size < COMPRESS_MIN_SIZE:
+                    continue
+                formats = []
+                check = site_path in changed_files or site_path not in digests
+                for format in args.compress:
+                    compressed_site_path = site_path + COMPRESSED_SUFFIXES[format]
+                    outputs.add(compressed_site_path)
+                    try:
+                        if not check and os.stat(dir_output+compressed_site_path).st_mtime_ns >= stat.st_mtime_ns:
+                            continue
+                    except FileNotFoundError:
+                        pass
+                    formats.append(format)
+                if formats:
+                    compress_jobs.append((site_path, formats))
+            logging.info("checking the compressed copies of %s files", len(compress_jobs))
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                results = executor.map(lambda job: compress_output(dir_output+job[0], job[1], digests.get(job[0])), compress_jobs)
+                for (site_path, _), (digest, compressed) in zip(compress_jobs, results):
+                    digests[site_path] = digest
+                    changed_files.update(site_path + COMPRESSED_SUFFIXES[format] for format in compressed)
+            os.makedirs(dir_cache, exist_ok=True)
+            with open(record_path.with_suffix('.tmp'), 'w', encoding='utf-8') as outfile:
+                json.dump({'output':dir_output, 'files':{site_path: digest for site_path, digest in digests.items() if site_path in outputs}}, outfile)
+            os.replace(record_path.with_suffix('.tmp'), record_path)
+            end_stage('compress')
+
+        # remove what earlier builds left in a reused output directory, e.g. outputs of deleted wiki files
+        if reuse_output:
+            if args.incremental:
+                outputs.add('/'+MANIFEST_FILENAME) # rewritten below
+            changed_files.update(remove_stale_outputs(dir_output, outputs, build_started_ns))
+            end_stage('cleanup')
+
+        # save the manifest for the next incremental build (under --watch, watch() saves it on exit)
+        if args.incremental:
+            manifest = {
+                'version':MANIFEST_VERSION,
+                'fingerprint':fingerprint,
+                'sources':sources,
+            }
+            if 'sidebar' in config:
+                manifest['sidebar'] = {'name':config['sidebar'], 'body':sidebar_html}
+            if state is not None:
+                state['manifest'] = manifest
+            else:
+                save_manifest(manifest_path, manifest)
+            end_stage('manifest')
+
+        # create build results
+        build_results = {
+            'builder_name':APPNAME,
+            'builder_version':APPVERSION,
+            'build_time':build_time,
+            'pages':page_count,
+            'attachments':attachment_count,
+            'bytes_processed':bytes_processed,
+            'broken_links':len(link_graph.incipient_links()),
+            'duration':round(time.perf_counter() - build_start, 3),
+        }
+        if args.render_cache:
+            build_results['render_cache'] = render_cache_stats
+        write_site_file('/build-results.json', json.dumps(build_results))
+
+        # write the build profile if --profile
+        if args.profile:
+            write_profile(Path(dir_output) / PROFILE_FILENAME, sum(stage_times.values()), jobs,
+                          page_profiles)
+            changed_files.add('/'+PROFILE_FILENAME)
+
+        # write the list of changed output files if --changed-files
+        logging.info("%s output files added, changed, or removed", len(changed_files))
+        if args.changed_files:
+            with open(args.changed_files, 'w', encoding='utf-8') as outfile:
+                for site_path in sorted(changed_files):
+                    print(site_path[1:], file=outfile)
 
         # done
         logging.debug("done")
@@ -369,8 +1644,6 @@ def main():
     except subprocess.CalledProcessError as e:
         print(f"\nERROR: '{e.cmd[0]}' returned error code {e.returncode}.")
         print(f"Output was '{e.output}'")
-        if e.cmd[0] == 'node':
-            print(f"\nYou may need to install Node modules with 'npm ci'.\n")
         if e.cmd[0] == 'git':
             print(f"\nThere was a problem with Git.\n")
     except jinja2.exceptions.TemplateNotFound as e:
@@ -378,7 +1651,7 @@ def main():
     except FileNotFoundError as e:
         print(f"\n{e}\n\nCheck that arguments specify valid files and directories.\n")
     except Exception as e:
-        traceback.print_exc(e)
+        traceback.print_exc()
 
 if __name__ == "__main__":
     exit(main())
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+from pathlib import Path
+import platform
+import random
+import shlex
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource # not available on Windows
+except ImportError:
+    resource = None
+
+logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+MWB = Path(__file__).resolve().parents[2] / 'mwb.py'
+THEME = Path(__file__).resolve().parents[1] / 'bespoke-tests' / 'test-input' / '.massivewikibuilder' / 'this-wiki-themes' / 'basso'
+
+WORDS = '''
+wiki page link note garden idea project meeting summary draft review topic person place event history
+reference source quote question answer plan task goal result method data model system design process
+community library archive journal essay story chapter section outline index glossary concept theory
+'''.split()
+
+# the scenario parameters, which must match for results to be compared
+SCENARIO_KEYS = ['pages', 'words', 'links', 'broken_links', 'transclusion_depth', 'attachments', 'attachment_size', 'front_matter', 'seed', 'mwb_args']
+
+def page_name(i):
+    return f"Page {i}"
+
+def page_path(wiki, i):
+    # 100 pages to a folder, so the wiki has a realistic directory tree
+    return wiki / f"section {i // 100}" / f"{page_name(i)}.md"
+
+def front_matter(rng, count):
+    """
+    Returns a YAML front matter block with count keys, mixing strings, dates, lists and nested mappings.
+    """
+    if count == 0:
+        return ''
+    lines = ['---']
+    for k in range(count):
+        kind = k % 4
+        if kind == 0:
+            lines.append(f"key{k}: {' '.join(rng.choices(WORDS, k=4))}")
+        elif kind == 1:
+            lines.append(f"date{k}: 2023-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}")
+        elif kind == 2:
+            lines.append(f"tags{k}: [{', '.join(rng.choices(WORDS, k=3))}]")
+        else:
+            lines.append(f"meta{k}:")
+            lines.append(f"  author: {rng.choice(WORDS)}")
+            lines.append(f"  weight: {rng.randint(1, 100)}")
+    lines.append('---')
+    return '\n'.join(lines) + '\n'
+
+def generate_wiki(wiki, args):
+    """
+    Writes a synthetic wiki to the wiki directory, deterministically from args.seed.
+
+    Every page has args.words words of text in headings, paragraphs and lists, about args.links wikilinks
+    (args.broken_links of them to pages that don't exist), and args.front_matter front matter keys.
+    Every tenth page starts a chain of args.transclusion_depth transclusions, and args.attachments
+    attachments of args.attachment_size bytes are embedded in pages.
+    """
+    rng = random.Random(args.seed)
+    shutil.rmtree(wiki, ignore_errors=True)
+    wiki.mkdir(parents=True)
+    (wiki / 'README.md').write_text(f"# Synthetic wiki\n\n{args.pages} pages, see [[{page_name(0)}]].\n")
+    (wiki / 'Sidebar.md').write_text('\n'.join(f"- [[{page_name(i)}]]" for i in range(min(args.pages, 10))) + '\n')
+    for k in range(args.attachments):
+        (wiki / 'attachments').mkdir(exist_ok=True)
+        (wiki / 'attachments' / f"image {k}.png").write_bytes(rng.getrandbits(8 * args.attachment_size).to_bytes(args.attachment_size, 'little') if args.attachment_size else b'')
+    for i in range(args.pages):
+        parts = [front_matter(rng, args.front_matter), f"# {page_name(i)}\n"]
+        words_left = args.words
+        links_left = args.links
+        while words_left > 0:
+            count = min(words_left, rng.randint(20, 60))
+            text = ' '.join(rng.choices(WORDS, k=count))
+            words_left -= count
+            if links_left > 0 and args.pages > 1:
+                if rng.random() < args.broken_links:
+                    target = f"Missing page {rng.randrange(args.pages)}"
+                else:
+                    target = page_name(rng.randrange(args.pages))
+                text += f" see [[{target}]]" if rng.random() < 0.8 else f" see [[{target}|{rng.choice(WORDS)}]]"
+                links_left -= 1
+            parts.append(rng.choice(['', '## ', '- ']) + text + '\n')
+        # the rest of the links, if the text ran out first
+        parts.extend(f"- [[{page_name(rng.randrange(args.pages))}]]\n" for _ in range(links_left if args.pages > 1 else 0))
+        if args.transclusion_depth and i % 10 < args.transclusion_depth and i + 1 < args.pages:
+            parts.append(f"\n![[{page_name(i + 1)}]]\n")
+        if args.attachments and i % 10 == 5:
+            parts.append(f"\n![[image {rng.randrange(args.attachments)}.png]]\n")
+        path = page_path(wiki, i)
+        path.parent.mkdir(exist_ok=True)
+        path.write_text('\n'.join(parts))
+
+def write_config(path):
+    path.write_text(
+        "wiki_title: Synthetic Wiki\n"
+        "author: bench_mwb.py\n"
+        "repo: ''\n"
+        "license: ''\n"
+        "recent_changes_count: 5\n"
+        "sidebar: Sidebar.md\n"
+    )
+
+def run_mwb(config, wiki, output, mwb_args):
+    """
+    Builds the wiki with mwb.py --profile, and returns the wall-clock time and the build profile.
+    """
+    cmd = [sys.executable, str(MWB), '-c', str(config), '-w', str(wiki), '-o', str(output), '-t', str(THEME), '--profile'] + shlex.split(mwb_args)
+    start = time.perf_counter()
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    profile_path = output / 'build-profile.json'
+    if result.returncode != 0 or not profile_path.exists():
+        logging.error(result.stdout)
+        logging.error(result.stderr)
+        raise RuntimeError("mwb.py build failed")
+    return wall, json.loads(profile_path.read_text())
+
+def measure_startup(repeat):
+    """
+    Starts mwb.py (with --help, so it imports what every build imports, then exits) repeat times, and returns
+    the median wall-clock time, and the cumulative import time in seconds of each top-level module, from
+    `python -X importtime`.
+    """
+    walls = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, str(MWB), '--help'], capture_output=True, check=True)
+        walls.append(time.perf_counter() - start)
+    result = subprocess.run([sys.executable, '-X', 'importtime', str(MWB), '--help'], capture_output=True, text=True, check=True)
+    imports = {}
+    for line in result.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package", nested imports are indented
+        if line.startswith('import time:') and line.count('|') == 2:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit() and not name[1:].startswith(' '):
+                imports[name.strip()] = int(cumulative) / 1e6
+    return statistics.median(walls), dict(sorted(imports.items(), key=lambda item: item[1], reverse=True))
+
+def benchmark(args):
+    """
+    Generates the wiki, builds it args.repeat times, and returns the results: the scenario, and the
+    median wall-clock time, stage times and page totals of the builds. Also measures the startup time of
+    mwb.py, and the median time of an incremental build with nothing to do.
+    """
+    work_dir = Path(args.work_dir) if args.work_dir else Path(tempfile.mkdtemp(prefix='mwb-bench-'))
+    try:
+        wiki = work_dir / 'wiki'
+        config = work_dir / 'mwb.yaml'
+        logging.info("Generating %s pages in %s...", args.pages, wiki)
+        generate_wiki(wiki, args)
+        write_config(config)
+        runs = []
+        for n in range(args.repeat):
+            wall, profile = run_mwb(config, wiki, work_dir / 'output', args.mwb_args)
+            logging.info("Build %s of %s: %.3fs", n + 1, args.repeat, wall)
+            runs.append((wall, profile))
+        # the first incremental build renders everything; the ones after it have nothing to do
+        run_mwb(config, wiki, work_dir / 'output-incremental', args.mwb_args + ' --incremental')
+        noop_walls = [run_mwb(config, wiki, work_dir / 'output-incremental', args.mwb_args + ' --incremental')[0] for _ in range(args.repeat)]
+        logging.info("No-op incremental build: %.3fs", statistics.median(noop_walls))
+        startup, imports = measure_startup(args.repeat)
+        logging.info("Startup: %.3fs", startup)
+    finally:
+        if not args.work_dir and not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    stages = {name for _, profile in runs for name in profile['stages']}
+    return {
+        'scenario':{key: getattr(args, key) for key in SCENARIO_KEYS},
+        'builder_version':runs[0][1]['builder_version'],
+        'python':platform.python_version(),
+        'platform':platform.platform(),
+        'repeat':args.repeat,
+        'wall':statistics.median(wall for wall, _ in runs),
+        'noop_wall':statistics.median(noop_walls),
+        'startup':startup,
+        'imports':imports,
+        'stages':{name: statistics.median(profile['stages'].get(name, 0.0) for _, profile in runs) for name in sorted(stages)},
+        'pages':{key: statistics.median(profile['pages'][key] for _, profile in runs) for key in runs[0][1]['pages']},
+        # peak resident set size of any build, in kilobytes (bytes on macOS)
+        'max_rss':resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss if resource else None,
+    }
+
+def compare_results(baseline, results, tolerance, min_time):
+    """
+    Compares results against baseline results for the same scenario.
+    Logs every time (and peak memory) that grew by more than tolerance, ignoring times under min_time seconds.
+    Returns True if nothing regressed.
+    """
+    passing = True
+    measures = [('wall', baseline['wall'], results['wall'])]
+    # (baselines from before startup and no-op builds were measured don't have them)
+    measures += [(name, baseline[name], results[name]) for name in ('noop_wall', 'startup') if name in baseline]
+    measures += [(f"stage {name}", seconds, results['stages'].get(name, 0.0)) for name, seconds in baseline['stages'].items()]
+    for name, old, new in measures:
+        change = (new - old) / old if old else 0.0
+        if max(old, new) >= min_time and change > tolerance:
+            passing = False
+            logging.error(f"REGRESSION {name}: {old:.3f}s -> {new:.3f}s ({change:+.0%})")
+        else:
+            logging.info(f"{name}: {old:.3f}s -> {new:.3f}s ({change:+.0%})")
+    if baseline.get('max_rss') and results.get('max_rss'):
+        change = (results['max_rss'] - baseline['max_rss']) / baseline['max_rss']
+        if change > tolerance:
+            passing = False
+            logging.error(f"REGRESSION max_rss: {baseline['max_rss']} -> {results['max_rss']} ({change:+.0%})")
+        else:
+            logging.info(f"max_rss: {baseline['max_rss']} -> {results['max_rss']} ({change:+.0%})")
+    return passing
+
+def setup_args():
+    parser = argparse.ArgumentParser(description="Benchmark mwb.py on a synthetic wiki, and compare the build times to a baseline.")
+    # the synthetic wiki
+    parser.add_argument('--pages', type=int, default=1000, help="Number of wiki pages. Default is 1000.")
+    parser.add_argument('--words', type=int, default=300, help="Words of text per page. Default is 300.")
+    parser.add_argument('--links', type=int, default=10, help="Wikilinks per page. Default is 10.")
+    parser.add_argument('--broken-links', type=float, default=0.05, help="Fraction of wikilinks to pages that don't exist. Default is 0.05.")
+    parser.add_argument('--transclusion-depth', type=int, default=3, help="Depth of the transclusion chain started by every tenth page (0 for none). Default is 3.")
+    parser.add_argument('--attachments', type=int, default=20, help="Number of attachments. Default is 20.")
+    parser.add_argument('--attachment-size', type=int, default=100000, help="Size of each attachment in bytes. Default is 100000.")
+    parser.add_argument('--front-matter', type=int, default=4, help="Front matter keys per page (0 for none). Default is 4.")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed for the synthetic wiki. Default is 1.")
+    # the benchmark
+    parser.add_argument('--mwb-args', default='', help="Extra arguments for mwb.py, e.g. '--jobs 4 --lunr'.")
+    parser.add_argument('--repeat', type=int, default=3, help="Number of builds to take the median of. Default is 3.")
+    parser.add_argument('--work-dir', help="Directory for the synthetic wiki and its output (kept afterwards). Default is a temporary directory.")
+    parser.add_argument('--keep', action='store_true', help="Keep the temporary work directory after the benchmark.")
+    parser.add_argument('--results', default='bench-results.json', help="File to write the results to. Default is 'bench-results.json'.")
+    parser.add_argument('--baseline', help="Results file from an earlier run to compare against; the exit code is 1 if anything got slower.")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Fraction by which a time may grow before it counts as a regression. Default is 0.2.")
+    parser.add_argument('--min-time', type=float, default=0.05, help="Ignore times shorter than this many seconds when comparing. Default is 0.05.")
+    return parser.parse_args()
+
+def main():
+    args = setup_args()
+    logging.info(f"args: {args}")
+
+    results = benchmark(args)
+    with open(args.results, 'w') as outfile:
+        json.dump(results, outfile, indent=2)
+    logging.info("Results written to %s", args.results)
+
+    if args.baseline:
+        with open(args.baseline) as infile:
+            baseline = json.load(infile)
+        if baseline['scenario'] != results['scenario']:
+            logging.error(f"Baseline scenario {baseline['scenario']} doesn't match {results['scenario']}")
+            return 2
+        if not compare_results(baseline, results, args.tolerance, args.min_time):
+            logging.error("Benchmark regressed against %s.", args.baseline)
+            return 1
+        logging.info("Benchmark finished, no regressions.")
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,297 @@
+"""
+File watching and live-reload preview server for `mwb.py --watch`.
+
+make_watcher() returns an InotifyWatcher on Linux, or a PollingWatcher elsewhere (or if inotify is
+unavailable); both have a changes() method that blocks until something changes and returns the changed
+paths. PreviewServer serves the output directory, injecting a script into every HTML page that reloads
+it when reload() is called after a rebuild.
+"""
+
+import ctypes
+import ctypes.util
+import functools
+import http.server
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+__all__ = ['make_watcher', 'InotifyWatcher', 'PollingWatcher', 'PreviewServer']
+
+# seconds without further changes before a batch of changes is reported, so an editor saving
+# (or a `git checkout` touching) many files triggers one rebuild
+DEBOUNCE = 0.05
+
+# seconds between scans of a PollingWatcher
+POLL_INTERVAL = 0.5
+
+# inotify event flags - see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, len
+
+def _watched(name):
+    # hidden files and directories are not part of the wiki (mwb.py's discovery skips them too)
+    return not name.startswith('.')
+
+def _walk(root, ignore):
+    # yield the directories under root to watch, skipping hidden and ignored ones
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if _watched(d) and os.path.join(dirpath, d) not in ignore]
+        yield dirpath, filenames
+
+class InotifyWatcher:
+    """
+    Watches directory trees and single files with Linux inotify, through ctypes.
+
+    Directories are watched recursively (including ones created later), except hidden directories and
+    those in ignore, e.g. the output directory. Single files are watched through their parent directory,
+    so editors that save by replacing the file are still seen.
+    """
+
+    def __init__(self, roots, files=(), ignore=()):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.ignore = {os.path.abspath(p) for p in ignore}
+        self.dirs = {} # watch descriptor -> directory
+        self.files = {} # watched directory -> names of single files watched in it (None for whole directories)
+        for path in files:
+            path = os.path.abspath(path)
+            names = self.files.setdefault(os.path.dirname(path), set())
+            if names is not None:
+                names.add(os.path.basename(path))
+            self._watch(os.path.dirname(path))
+        for root in roots:
+            self._watch_tree(os.path.abspath(root))
+
+    def _watch(self, path):
+        wd = self._add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            logging.warning("can't watch %s: %s", path, os.strerror(ctypes.get_errno()))
+        else:
+            self.dirs[wd] = path
+
+    def _watch_tree(self, root):
+        for dirpath, _ in _walk(root, self.ignore):
+            self.files[dirpath] = None
+            self._watch(dirpath)
+
+    def _read(self):
+        # return the paths named by the pending events, starting to watch new directories
+        changed = set()
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0'))
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                # events were lost; the build rescans the wiki anyway, so report the roots
+                changed.update(path for path, names in self.files.items() if names is None)
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            directory = self.dirs.get(wd)
+            if directory is None:
+                continue
+            names = self.files.get(directory)
+            if not name:
+                if names is None:
+                    changed.add(directory)
+                continue
+            if names is not None:
+                # a directory watched for single files
+                if name in names:
+                    changed.add(os.path.join(directory, name))
+                continue
+            if not _watched(name):
+                continue
+            path = os.path.join(directory, name)
+            if path in self.ignore:
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_tree(path)
+            changed.add(path)
+        return changed
+
+    def changes(self):
+        """
+        Block until something changes, then return the changed paths.
+        """
+        changed = set()
+        while True:
+            ready, _, _ = select.select([self.fd], [], [], DEBOUNCE if changed else None)
+            if not ready:
+                return changed
+            changed |= self._read()
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    """
+    Watches directory trees and single files by scanning them every POLL_INTERVAL seconds, for platforms
+    without inotify. Skips hidden directories and those in ignore, like InotifyWatcher.
+    """
+
+    def __init__(self, roots, files=(), ignore=()):
+        self.roots = [os.path.abspath(p) for p in roots]
+        self.files = [os.path.abspath(p) for p in files]
+        self.ignore = {os.path.abspath(p) for p in ignore}
+        self.snapshot = self._scan()
+
+    def _scan(self):
+        # return the mtime and size of every watched file
+        snapshot = {}
+        paths = list(self.files)
+        for root in self.roots:
+            paths.extend(os.path.join(dirpath, name) for dirpath, filenames in _walk(root, self.ignore) for name in filenames if _watched(name))
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def changes(self):
+        """
+        Block until something changes, then return the changed paths.
+        """
+        while True:
+            time.sleep(POLL_INTERVAL)
+            snapshot = self._scan()
+            changed = {path for path in snapshot.keys() | self.snapshot.keys() if snapshot.get(path) != self.snapshot.get(path)}
+            self.snapshot = snapshot
+            if changed:
+                return changed
+
+    def close(self):
+        pass
+
+def make_watcher(roots, files=(), ignore=()):
+    """
+    Return an InotifyWatcher where inotify is available, otherwise a PollingWatcher.
+    """
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(roots, files, ignore)
+        except (OSError, AttributeError) as e:
+            logging.warning("inotify is unavailable (%s), polling for changes instead", e)
+    return PollingWatcher(roots, files, ignore)
+
+# pages keep an EventSource open to RELOAD_PATH, which sends the build number on connecting and after
+# every rebuild; a page reloads when the number changes
+RELOAD_PATH = '/__mwb_reload'
+RELOAD_SCRIPT = (
+    '<script>new EventSource("' + RELOAD_PATH + '").onmessage = function (event) {'
+    ' if (window.mwbBuild && window.mwbBuild !== event.data) { location.reload(); }'
+    ' window.mwbBuild = event.data; };</script>'
+).encode()
+
+# seconds between keepalive comments on idle reload connections
+KEEPALIVE = 15
+
+class PreviewHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serves the output directory, with RELOAD_SCRIPT added to HTML pages and the RELOAD_PATH event stream.
+    """
+
+    preview = None # the PreviewServer, set on a subclass by PreviewServer
+
+    def do_GET(self):
+        if self.path == RELOAD_PATH:
+            return self.send_reload_events()
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) and self.path.split('?', 1)[0].endswith('/'):
+            path = os.path.join(path, 'index.html')
+        if path.endswith('.html') and os.path.isfile(path):
+            return self.send_html(path)
+        return super().do_GET()
+
+    def send_html(self, path):
+        with open(path, 'rb') as infile:
+            html = infile.read()
+        body_end = html.rfind(b'</body>')
+        html = html[:body_end] + RELOAD_SCRIPT + html[body_end:] if body_end >= 0 else html + RELOAD_SCRIPT
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(html)))
+        self.end_headers()
+        self.wfile.write(html)
+
+    def send_reload_events(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        sent = None
+        try:
+            while True:
+                with self.preview.condition:
+                    self.preview.condition.wait_for(lambda: self.preview.build != sent, timeout=KEEPALIVE)
+                    build = self.preview.build
+                if build == sent:
+                    self.wfile.write(b': keepalive\n\n')
+                else:
+                    self.wfile.write(f'data: {build}\n\n'.encode())
+                    sent = build
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def end_headers(self):
+        # files keep their names across rebuilds (e.g. the lunr index under --watch), so browsers must check for changes
+        self.send_header('Cache-Control', 'no-cache')
+        super().end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug("preview server: " + format, *args)
+
+class PreviewServer:
+    """
+    Serves directory on port in a background thread, reloading open pages when reload() is called.
+    """
+
+    def __init__(self, directory, port, host='localhost'):
+        self.build = 1
+        self.condition = threading.Condition()
+        handler = type('Handler', (PreviewHandler,), {'preview': self})
+        self.httpd = http.server.ThreadingHTTPServer((host, port), functools.partial(handler, directory=str(directory)))
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def reload(self):
+        """
+        Tell open pages that the site was rebuilt.
+        """
+        with self.condition:
+            self.build += 1
+            self.condition.notify_all()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()